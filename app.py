@@ -1,72 +1,445 @@
 """Flask App for Flask Cafe."""
 
-import os
-from dotenv import load_dotenv
+import hashlib
+import math
+import time
+import click
 
 from flask import Flask, render_template, url_for, redirect, flash, session, g
-from flask import jsonify, request
+from flask import Blueprint, jsonify, request, abort, current_app
+from flask import get_template_attribute, get_flashed_messages
+from flask_wtf.csrf import generate_csrf
 from flask_debugtoolbar import DebugToolbarExtension
+from markupsafe import Markup
 from sqlalchemy.exc import IntegrityError
+from werkzeug.local import LocalProxy
+from werkzeug.middleware.proxy_fix import ProxyFix
 
 from models import db, connect_db, Cafe, City, User, Like, Specialty
+from models import CAFE_SORTS, city_registry
 from models import DEFAULT_CAFE_IMAGE_URL, DEFAULT_USER_IMAGE_URL
 from forms import CafeForm, SignupForm, LoginForm, ProfileEditForm, \
     CSRFProtectForm, SpecialtyForm
+from cache import TTLCache, page_cache
+from config import get_config
+from hashing import password_hasher, HasherBusy, calibrate
+import migrations
+from metrics import metrics
+from pagination import InvalidCursor
+from pooling import bind_engine_options
+from queries import loader_options, get_cafe_snapshot
+from queries import get_cafe_validator, get_cafes_validator
+from ratelimit import login_limiter
+
+bp = Blueprint("main", __name__, cli_group=None)
+
+
+def create_app(config_name=None, config=None):
+    """Create and return the Flask app.
+
+    config_name is one of config.CONFIGS: "development", "testing" or
+    "production" (default: FLASK_CONFIG env var, or "development").
+    config is an optional dict of settings to use over the profile's.
+    """
+
+    app = Flask(__name__)
+    app.config.from_object(get_config(config_name))
+    app.config.update(config or {})
+    (app.config['SQLALCHEMY_ENGINE_OPTIONS'],
+     app.config['SQLALCHEMY_BINDS']) = bind_engine_options(
+        app.config['SQLALCHEMY_ENGINE_OPTIONS'],
+        app.config['SQLALCHEMY_BINDS'])
+
+    if app.config['DEBUG_TB_ENABLED']:
+        DebugToolbarExtension(app)
+
+    if app.config['TRUSTED_PROXY_HOPS']:
+        # take the client's IP (e.g. for login rate limits) & scheme from
+        # the X-Forwarded-* headers our own proxies add
+        hops = app.config['TRUSTED_PROXY_HOPS']
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=hops, x_proto=hops)
+
+    connect_db(app)
+    password_hasher.init_app(app)
+    login_limiter.init_app(app)
+    page_cache.init_app(app)
 
-load_dotenv()
+    user_cache.ttl = app.config['USER_CACHE_TTL']
+    user_cache.clear()
 
-app = Flask(__name__)
+    app.register_blueprint(bp)
 
-app.config['SQLALCHEMY_DATABASE_URI'] = os.environ['DATABASE_URL']
-app.config['SECRET_KEY'] = os.environ['SECRET_KEY']
-app.config['SQLALCHEMY_ECHO'] = True
-# app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
+    return app
+
+
+def warm_up(app):
+    """Load what every worker would otherwise load on its first requests:
+    compiled templates & the city registry.
+
+    Call in the parent of a pre-fork server (see wsgi.py), so workers share
+    these copy-on-write. Closes the parent's database connections after,
+    so none are inherited by the workers.
+    """
 
-toolbar = DebugToolbarExtension(app)
-connect_db(app)
-# print('SQLALCHEMY_DATABASE_URI: ', app.config['SQLALCHEMY_DATABASE_URI'])
+    for name in app.jinja_env.list_templates(extensions=["html"]):
+        app.jinja_env.get_template(name)
+
+    with app.app_context():
+        city_registry.load()
+
+        for engine in db.engines.values():
+            engine.dispose()
+
+
+def after_fork(app):
+    """Make a freshly forked worker process safe to serve requests: drop
+    database connections, bcrypt workers and rate limit & cache connections
+    inherited from the parent (without closing them, as the parent and other
+    workers may still use them).
+    """
+
+    with app.app_context():
+        for engine in db.engines.values():
+            engine.dispose(close=False)
+
+    password_hasher.after_fork()
+    login_limiter.after_fork()
+    page_cache.after_fork()
 
 
 #######################################
 # utilities
 
 # https://flask.palletsprojects.com/en/2.3.x/errorhandling/
-@app.errorhandler(404)
+@bp.app_errorhandler(404)
 def page_not_found(e):
     """Return a custom 404 page."""
     return render_template('404.html'), 404
 
+#######################################
+# read replica
+
+PRIMARY_UNTIL_COOKIE = "primary_until"
+
+
+@bp.before_app_request
+def route_reads():
+    """Send this request's reads to the read replica, if there is one and
+    it's a GET (or HEAD) from a browser that hasn't just written.
+
+    After a write, a browser reads from the primary for
+    REPLICA_STICKY_SECONDS (see stick_to_primary), so it sees its own
+    writes even while the replica lags behind.
+    """
+
+    try:
+        primary_until = float(request.cookies.get(PRIMARY_UNTIL_COOKIE, 0))
+    except ValueError:
+        primary_until = 0
+
+    db.session.info["wrote"] = False
+    db.session.info["use_replica"] = (
+        request.method in ("GET", "HEAD")
+        and primary_until < time.time())
+
+
+@bp.after_app_request
+def stick_to_primary(response):
+    """If this request wrote to the database, keep this browser's reads on
+    the primary for a while.
+    """
+
+    if (db.session.info.get("wrote")
+            and current_app.config['SQLALCHEMY_BINDS']):
+        seconds = current_app.config['REPLICA_STICKY_SECONDS']
+        response.set_cookie(PRIMARY_UNTIL_COOKIE,
+                            str(int(time.time() + seconds)),
+                            max_age=seconds,
+                            httponly=True,
+                            samesite="Lax")
+
+    return response
+
+
+@bp.teardown_app_request
+def stop_routing_reads(exc):
+    """Reads outside of requests (e.g. commands) use the primary."""
+
+    db.session.info.pop("use_replica", None)
+    db.session.info.pop("wrote", None)
+
+
+def from_primary(make):
+    """Return make (e.g. for page_cache.get_or_set), changed to read from
+    the primary: what's cached after an invalidation must be at least as
+    new as the change, which a lagging replica might not have yet.
+    """
+
+    def make_from_primary(*args, **kwargs):
+        use_replica = db.session.info.get("use_replica")
+        db.session.info["use_replica"] = False
+
+        try:
+            return make(*args, **kwargs)
+        finally:
+            db.session.info["use_replica"] = (
+                use_replica and not db.session.info.get("wrote"))
+
+    return make_from_primary
+
+
+#######################################
+# conditional GET
+
+
+def is_public_page():
+    """Is this page the same for every visitor (anonymous, with nothing
+    flashed)? Only those get ETags; others show the user's name, likes, etc.
+    """
+
+    return CURR_USER_KEY not in session and "_flashes" not in session
+
+
+def make_etag(*validator):
+    """Return a strong ETag made from validator (cheap values that change
+    whenever the page would), and the current release.
+
+    Views also key cached pages by it, so a page cached by a process that
+    hasn't seen a change yet isn't served under the changed page's ETag.
+    """
+
+    return hashlib.sha1(
+        repr((current_app.config['RELEASE'], validator)).encode()
+    ).hexdigest()
+
+
+def not_modified(etag, shared=False):
+    """Give this response etag (see make_etag). If shared, the page is the
+    same for everyone (see SHARED_PAGES), so shared caches may keep it too.
+
+    Returns a 304 Not Modified response if the client has this version
+    already, so the view can return it before loading or rendering
+    anything; else None.
+    """
+
+    g.etag = etag
+    g.shared_page = shared
+
+    # If-None-Match compares weakly: proxies that compress responses (e.g.
+    # nginx) send the ETag on as W/"..."
+    if request.if_none_match.contains_weak(etag):
+        return current_app.response_class(status=304)
+
+    return None
+
+
+@bp.after_app_request
+def add_etag(response):
+    """Send the ETag set by not_modified, asking browsers to revalidate
+    (rather than reuse) what they've stored.
+
+    Shared pages may be kept by shared caches (e.g. a CDN) for
+    SHARED_PAGE_MAX_AGE seconds, unless the session was used after all,
+    which would make the page the user's own.
+    """
+
+    etag = g.pop("etag", None)
+    shared = g.pop("shared_page", False)
+
+    if etag and response.status_code in (200, 304):
+        response.set_etag(etag)
+
+        if shared and not session.accessed:
+            response.cache_control.public = True
+            response.cache_control.max_age = 0
+            response.cache_control.s_maxage = (
+                current_app.config['SHARED_PAGE_MAX_AGE'])
+        else:
+            response.cache_control.no_cache = True
+            response.vary.add("Cookie")
+
+    return response
+
+
+#######################################
+# commands
+
+
+@bp.cli.command("reconcile-like-counts")
+def reconcile_like_counts():
+    """Recount every cafe's likes from cafes_users and fix like_count."""
+
+    fixed = Cafe.reconcile_like_counts()
+    db.session.commit()
+
+    print(f"Fixed like counts for {fixed} cafe(s).")
+
+
+@bp.cli.command("migrate")
+@click.option("--status", "show_status", is_flag=True,
+              help="List migrations & whether they're applied, only.")
+def migrate_db(show_status):
+    """Apply pending schema migrations (see migrations.py)."""
+
+    if show_status:
+        for version, name, applied in migrations.status():
+            print(f"{version:4} {name:<32} {'applied' if applied else '-'}")
+        return
+
+    applied = migrations.migrate()
+    print(f"Applied {len(applied)} migration(s): {', '.join(applied)}"
+          if applied else "Nothing to migrate.")
+
+
+@bp.cli.command("calibrate-bcrypt")
+@click.option("--target-ms", default=250, show_default=True,
+              help="Longest acceptable time to hash one password.")
+def calibrate_bcrypt(target_ms):
+    """Time bcrypt on this host & suggest a BCRYPT_WORK_FACTOR."""
+
+    timings, suggested = calibrate(target_ms / 1000)
+
+    for rounds, seconds in timings:
+        print(f"work factor {rounds:2}: {seconds * 1000:8.1f} ms")
+
+    print(f"Suggested BCRYPT_WORK_FACTOR={suggested} "
+          f"(now {current_app.config['BCRYPT_WORK_FACTOR']}).")
+
 #######################################
 # auth & auth routes
 
 
+CAFES_PER_PAGE = 24
+MAX_CAFES_PER_PAGE = 100
+MAX_LIKES_BATCH = 500
+
 CURR_USER_KEY = "curr_user"
+CURR_USER_INFO_KEY = "curr_user_info"
 NOT_LOGGED_IN_MSG = "You are not logged in."
 ADMIN_ONLY_MSG = "For administrators only."
+TOO_BUSY_MSG = "We're very busy right now. Please try again in a moment."
+TOO_MANY_LOGINS_MSG = "Too many login attempts. Please try again later."
+
+# users by id, as User.to_cache() dicts; saves loading the curr user from
+# the database on every request (ttl: USER_CACHE_TTL, set by create_app)
+user_cache = TTLCache(maxsize=1024)
+
 
+class SessionUser:
+    """The logged in user's id, username, admin flag and full name, as kept
+    in the (signed) session: enough for most pages, with no database query.
+
+    Only use this for what to show; check permissions with g.user.
+    """
 
-@app.before_request
+    def __init__(self, id, username, admin, full_name):
+        self.id = id
+        self.username = username
+        self.admin = admin
+        self.full_name = full_name
+
+    def get_full_name(self):
+        return self.full_name
+
+
+@bp.before_app_request
 def add_user_to_g():
-    """If we're logged in, add curr user to Flask global."""
+    """Add curr user to Flask global, without loading it yet.
 
-    if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+    g.user is the curr User (or None if not logged in), loaded the first
+    time it's used. g.session_user is the curr SessionUser (or None).
+    """
 
-    else:
-        g.user = None
+    # g outlives a request when an app context is already pushed
+    g.pop("_curr_user", None)
+
+    g.user = LocalProxy(get_curr_user)
+    g.session_user = LocalProxy(get_session_user)
+
+
+def get_curr_user():
+    """Return curr user, or None if not logged in.
+
+    Loaded at most once per request, and from user_cache when possible.
+    """
+
+    if "_curr_user" not in g:
+        user_id = session.get(CURR_USER_KEY)
+        g._curr_user = None if user_id is None else load_user(user_id)
 
+    return g._curr_user
 
-@app.before_request
+
+def load_user(user_id):
+    """Return user with this id (or None), using user_cache."""
+
+    values = user_cache.get(user_id)
+
+    if values is not None:
+        return User.from_cache(values)
+
+    user = db.session.get(User, user_id)
+
+    if user:
+        user_cache.set(user_id, user.to_cache())
+
+    return user
+
+
+def get_session_user():
+    """Return SessionUser for curr user, or None if not logged in."""
+
+    if CURR_USER_KEY not in session:
+        return None
+
+    if CURR_USER_INFO_KEY not in session:
+        # session from before user info was kept in it
+        user = get_curr_user()
+
+        if not user:
+            return None
+
+        remember_user_info(user)
+
+    return SessionUser(session[CURR_USER_KEY], **session[CURR_USER_INFO_KEY])
+
+
+def remember_user_info(user):
+    """Keep the fields of SessionUser for this user in the session."""
+
+    session[CURR_USER_INFO_KEY] = {
+        "username": user.username,
+        "admin": user.admin,
+        "full_name": user.get_full_name(),
+    }
+
+
+@bp.before_app_request
 def add_csrf_to_g():
-    """Add CSRF form to Flask global."""
+    """Add CSRF form to Flask global, without building it yet.
+
+    Building the form makes a CSRF token (and touches the session), so it's
+    only done for requests whose view or template uses g.csrf_form.
+    """
+
+    g.pop("_csrf_form", None)
+    g.csrf_form = LocalProxy(get_csrf_form)
 
-    g.csrf_form = CSRFProtectForm()
+
+def get_csrf_form():
+    """Return CSRF form for this request, building it on first use."""
+
+    if "_csrf_form" not in g:
+        g._csrf_form = CSRFProtectForm()
+
+    return g._csrf_form
 
 
 def do_login(user):
     """Log in user."""
 
     session[CURR_USER_KEY] = user.id
+    remember_user_info(user)
 
 
 def do_logout():
@@ -75,16 +448,18 @@ def do_logout():
     if CURR_USER_KEY in session:
         del session[CURR_USER_KEY]
 
+    session.pop(CURR_USER_INFO_KEY, None)
+
 
 def handle_not_logged_in():
     """Flashes a 'not logged in' message and redirects user to login page."""
     flash(NOT_LOGGED_IN_MSG, 'danger')
-    return redirect(url_for('login'))
+    return redirect(url_for('main.login'))
 
 #######################################
 # homepage
 
-@app.get("/")
+@bp.get("/")
 def homepage():
     """Show homepage."""
 
@@ -94,41 +469,145 @@ def homepage():
 #######################################
 # cafes
 
-@app.get('/cafes')
+@bp.get('/cafes')
 def cafe_list():
-    """Return list of all cafes."""
+    """Return a page of cafes, sorted by name or by most liked.
+
+    Accepts URL query string: "/cafes?sort=name|popular&after=<cursor>",
+    where cursor is the next page cursor linked from the previous page.
+
+    Anonymous visitors (everyone, with SHARED_PAGES) get an ETag, & a 304
+    if they have the page already.
+    """
+
+    after = request.args.get("after")
+    sort = request.args.get("sort", "name")
+
+    if sort not in CAFE_SORTS:
+        abort(400)
+
+    shared = current_app.config['SHARED_PAGES']
+    validator = get_cafes_validator(likes=sort == "popular")
+    etag = make_etag(*validator)
+    # cards show city names: reload them if another process changed them
+    city_registry.sync(validator[1])
+
+    if shared or is_public_page():
+        response = not_modified(etag, shared=shared)
+
+        if response:
+            return response
 
-    cafes = Cafe.query.order_by('name').all()
+    def render_cards():
+        try:
+            cafes, next_cursor = Cafe.get_page(
+                after, CAFES_PER_PAGE, loader_options("list"), sort)
+        except InvalidCursor:
+            abort(400)
+
+        return render_template(
+            'cafe/_cards.html',
+            cards=render_cafe_cards(cafes, show_likes=sort == "popular"),
+            sort=sort,
+            is_first_page=not after,
+            next_cursor=next_cursor,
+        )
+
+    if after:
+        # only first pages are cached whole: cursors come from clients, so
+        # could be anything (each card is cached still)
+        cards = render_cards()
+    else:
+        # like counts are only shown when sorting by them
+        tags = ["cafe-list"] + (["like-counts"] if sort == "popular" else [])
+        cards = page_cache.get_or_set(
+            f"cafe-list:{sort}:{etag}", from_primary(render_cards), tags)
 
     return render_template(
-        'cafe/list.html',
-        cafes=cafes,
-    )
+        'cafe/list.html', sort=sort, cards=Markup(cards), shared=shared)
+
+
+def render_cafe_cards(cafes, show_likes=False):
+    """Return list of the cafes' cards (HTML), rendering only those that
+    aren't cached.
+
+    A card is cached by cafe id & version (bumped by edits), the version of
+    the city names it's rendered with (see CityRegistry), and like count if
+    shown; the cafes need only the columns in the "list" loader profile, as
+    cafes with cards to render are loaded in full, all at once.
+    """
+
+    cities = city_registry.version
+    keys = {cafe.id: f"card:{cafe.id}:{cafe.version}:{cities}"
+                     + (f":{cafe.like_count}" if show_likes else "")
+            for cafe in cafes}
+    cards = page_cache.get_many(keys.values())
+
+    missing = [id for id, key in keys.items() if key not in cards]
+
+    if missing:
+        card = get_template_attribute('cafe/_card.html', 'card')
+
+        for cafe in db.session.scalars(
+                db.select(Cafe).where(Cafe.id.in_(missing))):
+            key = keys[cafe.id]
+            cards[key] = str(card(cafe, show_likes))
+            page_cache.set(key, cards[key], ["cities"])
+
+        metrics.incr("cafe_list.cards_rendered", len(missing))
+
+    return [Markup(cards[key]) for key in keys.values()]
 
 
-@app.get('/cafes/<int:cafe_id>')
+@bp.get('/cafes/<int:cafe_id>')
 def cafe_detail(cafe_id):
-    """Show detail for cafe."""
+    """Show detail for cafe.
 
-    cafe = Cafe.query.get_or_404(cafe_id)
-    specialties = (Specialty
-                   .query
-                   .filter(Specialty.cafe_id == cafe_id)
-                   .order_by(Specialty.type == 'side',
-                             Specialty.type == 'course',
-                             Specialty.type == 'dessert',
-                             Specialty.type == 'beverage',
-                             Specialty.name.asc())
-                   .all())
+    The cafe is cached (for everyone) by its ETag; whether the user likes
+    it isn't. Anonymous visitors (everyone, with SHARED_PAGES) get the
+    ETag, & a 304 if they have the page already.
+    """
+
+    shared = current_app.config['SHARED_PAGES']
+    validator = get_cafe_validator(cafe_id)
+
+    if validator is None:
+        abort(404)
+
+    etag = make_etag(*validator)
+
+    if shared or is_public_page():
+        response = not_modified(etag, shared=shared)
+
+        if response:
+            return response
+
+    cafe = page_cache.get_or_set(
+        f"cafe:{cafe_id}:{etag}",
+        from_primary(lambda: get_cafe_snapshot(cafe_id)),
+        tags=[f"cafe:{cafe_id}"],
+        more_tags=lambda cafe: [f"city:{cafe.city_code}"])
+
+    if cafe is None:
+        abort(404)
+
+    if shared:
+        # filled in by the browser, from /api/me/state
+        liked = None
+    else:
+        user_id = session.get(CURR_USER_KEY)
+        liked = user_id is not None and Like.exists(user_id, cafe_id)
 
     return render_template(
         'cafe/detail.html',
         cafe=cafe,
-        specialties=specialties
+        liked=liked,
+        specialties_by_type=cafe.get_specialties_by_type(),
+        shared=shared,
     )
 
 
-@app.route('/cafes/add', methods=["GET", "POST"])
+@bp.route('/cafes/add', methods=["GET", "POST"])
 def add_cafe():
     """ GET: Shows form for adding a cafe.
 
@@ -141,11 +620,11 @@ def add_cafe():
 
     if not g.user:
         flash(NOT_LOGGED_IN_MSG, 'danger')
-        return redirect(url_for('login'))
+        return redirect(url_for('main.login'))
 
     elif not g.user.admin:
         flash(ADMIN_ONLY_MSG, 'danger')
-        return redirect(url_for('cafe_list'))
+        return redirect(url_for('main.cafe_list'))
 
     form = CafeForm()
 
@@ -183,7 +662,7 @@ def add_cafe():
             )
 
         flash(f'{cafe.name} added!', 'success')
-        return redirect(url_for('cafe_detail', cafe_id=cafe.id))
+        return redirect(url_for('main.cafe_detail', cafe_id=cafe.id))
 
     else:
 
@@ -193,7 +672,7 @@ def add_cafe():
         )
         
 
-@app.route('/cafes/<int:cafe_id>/edit', methods=["GET", "POST"])
+@bp.route('/cafes/<int:cafe_id>/edit', methods=["GET", "POST"])
 def edit_cafe(cafe_id):
     """ GET: Shows form for editing a cafe.
     POST: Handle editing a cafe and redirects to cafe's detail page on
@@ -205,11 +684,11 @@ def edit_cafe(cafe_id):
 
     if not g.user:
         flash(NOT_LOGGED_IN_MSG, 'danger')
-        return redirect(url_for('login'))
+        return redirect(url_for('main.login'))
 
     elif not g.user.admin:
         flash(ADMIN_ONLY_MSG, 'danger')
-        return redirect(url_for('cafe_detail', cafe_id=cafe_id))
+        return redirect(url_for('main.cafe_detail', cafe_id=cafe_id))
 
     cafe = Cafe.query.get_or_404(cafe_id)
     form = CafeForm(obj=cafe)
@@ -235,7 +714,7 @@ def edit_cafe(cafe_id):
             )
 
         flash(f'{cafe.name} edited!', 'success')
-        return redirect(url_for('cafe_detail', cafe_id=cafe.id))
+        return redirect(url_for('main.cafe_detail', cafe_id=cafe.id))
 
     else:
         return render_template(
@@ -245,7 +724,7 @@ def edit_cafe(cafe_id):
         )
 
 
-@app.route('/cafes/<int:cafe_id>/specialties', methods=["GET", "POST"])
+@bp.route('/cafes/<int:cafe_id>/specialties', methods=["GET", "POST"])
 def add_specialty(cafe_id):
     """ GET: Shows form for adding a specialty to a cafe.
     POST: Handle adding a specialty and redirects to cafe's detail page on
@@ -257,11 +736,11 @@ def add_specialty(cafe_id):
 
     if not g.user:
         flash(NOT_LOGGED_IN_MSG, 'danger')
-        return redirect(url_for('login'))
+        return redirect(url_for('main.login'))
 
     elif not g.user.admin:
         flash(ADMIN_ONLY_MSG, 'danger')
-        return redirect(url_for('cafe_detail', cafe_id=cafe_id))
+        return redirect(url_for('main.cafe_detail', cafe_id=cafe_id))
 
     cafe = Cafe.query.get_or_404(cafe_id)
     form = SpecialtyForm()
@@ -285,7 +764,7 @@ def add_specialty(cafe_id):
                 'cafe/add-specialty-form.html', form=form)
 
         flash(f"Added '{specialty.name}'.", 'success')
-        return redirect(url_for('cafe_detail', cafe_id=cafe_id))
+        return redirect(url_for('main.cafe_detail', cafe_id=cafe_id))
 
     else:
         return render_template(
@@ -294,7 +773,7 @@ def add_specialty(cafe_id):
         )
 
 
-@app.route('/cafes/<int:cafe_id>/specialties/<int:specialty_id>',
+@bp.route('/cafes/<int:cafe_id>/specialties/<int:specialty_id>',
            methods=["GET", "POST"])
 def edit_specialty(cafe_id, specialty_id):
     """ GET: Shows form for editing a specialty to a cafe.
@@ -307,11 +786,11 @@ def edit_specialty(cafe_id, specialty_id):
 
     if not g.user:
         flash(NOT_LOGGED_IN_MSG, 'danger')
-        return redirect(url_for('login'))
+        return redirect(url_for('main.login'))
 
     elif not g.user.admin:
         flash(ADMIN_ONLY_MSG, 'danger')
-        return redirect(url_for('cafe_detail', cafe_id=cafe_id))
+        return redirect(url_for('main.cafe_detail', cafe_id=cafe_id))
 
     cafe = Cafe.query.get_or_404(cafe_id)
     specialty = Specialty.query.get_or_404(specialty_id)
@@ -332,7 +811,7 @@ def edit_specialty(cafe_id, specialty_id):
             return render_template('cafe/edit-specialty-form.html', form=form)
 
         flash(f"Edited '{specialty.name}'.", 'success')
-        return redirect(url_for('cafe_detail', cafe_id=cafe_id))
+        return redirect(url_for('main.cafe_detail', cafe_id=cafe_id))
 
     else:
         return render_template(
@@ -341,7 +820,7 @@ def edit_specialty(cafe_id, specialty_id):
         )
 
 
-@app.route('/cafes/<int:cafe_id>/delete', methods=["GET", "POST"])
+@bp.route('/cafes/<int:cafe_id>/delete', methods=["GET", "POST"])
 def delete_cafe(cafe_id):
     """ GET: Shows confirmation to delete a cafe.
     POST: Deletes a cafe.
@@ -352,11 +831,11 @@ def delete_cafe(cafe_id):
 
     if not g.user:
         flash(NOT_LOGGED_IN_MSG, 'danger')
-        return redirect(url_for('login'))
+        return redirect(url_for('main.login'))
 
     elif not g.user.admin:
         flash(ADMIN_ONLY_MSG, 'danger')
-        return redirect(url_for('cafe_detail', cafe_id=cafe_id))
+        return redirect(url_for('main.cafe_detail', cafe_id=cafe_id))
 
     cafe = Cafe.query.get_or_404(cafe_id)
 
@@ -368,7 +847,7 @@ def delete_cafe(cafe_id):
         db.session.commit()
 
         flash(f"Deleted '{cafe.name}' 🪦 R.I.P", 'warning')
-        return redirect(url_for('cafe_list'))
+        return redirect(url_for('main.cafe_list'))
 
     else:
         return render_template(
@@ -380,7 +859,7 @@ def delete_cafe(cafe_id):
 # user signup/login/logout
 
 
-@app.route('/signup', methods=["GET", "POST"])
+@bp.route('/signup', methods=["GET", "POST"])
 def signup():
     """ GET: Shows registration form.
 
@@ -401,7 +880,11 @@ def signup():
     # TODO: does not strip whitespace on inputs when validating
     if form.validate_on_submit():
 
-        user = User.register(**data)
+        try:
+            user = User.register(**data)
+        except HasherBusy:
+            flash(TOO_BUSY_MSG, 'danger')
+            return render_template('auth/signup-form.html', form=form), 503
         # user = User.register(form.username.data,
         #                      form.password.data,
         #                      form.first_name.data,
@@ -428,7 +911,7 @@ def signup():
         # add_user_to_g()
         
         flash('You are signed up and logged in.', 'success')
-        return redirect(url_for('cafe_list'))
+        return redirect(url_for('main.cafe_list'))
 
     else:
         return render_template(
@@ -437,7 +920,7 @@ def signup():
         )
 
 
-@app.route('/login', methods=["GET", "POST"])
+@bp.route('/login', methods=["GET", "POST"])
 def login():
     """ GET: Show login form.
 
@@ -449,14 +932,26 @@ def login():
 
     if form.validate_on_submit():
 
-        user = User.authenticate(form.username.data,
-                                 form.password.data)
+        retry_after = login_limiter.check(form.username.data,
+                                          request.remote_addr)
+
+        if retry_after:
+            flash(TOO_MANY_LOGINS_MSG, 'danger')
+            html = render_template('auth/login-form.html', form=form)
+            return html, 429, {"Retry-After": str(math.ceil(retry_after))}
+
+        try:
+            user = User.authenticate(form.username.data,
+                                     form.password.data)
+        except HasherBusy:
+            flash(TOO_BUSY_MSG, 'danger')
+            return render_template('auth/login-form.html', form=form), 503
 
         if user:
             do_login(user)
         
             flash(f'Hello, {user.username}', 'success')
-            return redirect(url_for('cafe_list'))
+            return redirect(url_for('main.cafe_list'))
 
         else:
             flash("Invalid credentials", 'danger')
@@ -467,7 +962,7 @@ def login():
     )
 
 
-@app.post('/logout')
+@bp.post('/logout')
 def logout():
     """ Process logout. Redirects to homepage with flashed message
         “You should have successfully logged out.”
@@ -476,13 +971,13 @@ def logout():
     do_logout()
 
     flash("You should have successfully logged out.", 'success')
-    return redirect(url_for('homepage'))
+    return redirect(url_for('main.homepage'))
 
 #######################################
 # user profile
 
 
-@app.get('/profile')
+@bp.get('/profile')
 def show_profile():
     """If logged in, show current user's profile.
     If not logged in, redirect to login form with flashed NOT_LOGGED_IN_MSG.
@@ -492,14 +987,15 @@ def show_profile():
 
         return render_template(
             'profile/detail.html',
+            liked_cafes=g.user.get_liked_cafes(loader_options("profile")),
         )
 
     else:
         flash(NOT_LOGGED_IN_MSG, 'danger')
-        return redirect(url_for('login'))
+        return redirect(url_for('main.login'))
 
 
-@app.route('/profile/edit', methods=["GET", "POST"])
+@bp.route('/profile/edit', methods=["GET", "POST"])
 def edit_profile():
     """ GET: Show profile edit form if logged in.
 
@@ -522,8 +1018,11 @@ def edit_profile():
             form.populate_obj(g.user)
             db.session.commit()
 
+            user_cache.delete(g.user.id)
+            remember_user_info(g.user)
+
             flash('Profile edited.', 'success')
-            return redirect(url_for('show_profile'))
+            return redirect(url_for('main.show_profile'))
 
         else:
             return render_template(
@@ -533,35 +1032,213 @@ def edit_profile():
 
     else:
         flash(NOT_LOGGED_IN_MSG, 'danger')
-        return redirect(url_for('login'))
+        return redirect(url_for('main.login'))
+
+#######################################
+# metrics API
+
+
+@bp.get('/api/metrics')
+def show_metrics():
+    """ Show this process's metrics (see metrics.Metrics.snapshot).
+        Returns JSON: {"counters": {...}, "gauges": {...}, "timings": {...}}
+
+    If not logged in, return JSON with status 401: {"error": "Not logged in"}
+    If not admin, return JSON with status 403: {"error": ADMIN_ONLY_MSG}
+    """
+
+    if not g.user:
+        return jsonify({"error": "Not logged in"}), 401
+
+    elif not g.user.admin:
+        return jsonify({"error": ADMIN_ONLY_MSG}), 403
+
+    return jsonify(metrics.snapshot())
+
+#######################################
+# cafes API
+
+
+@bp.get('/api/cafes')
+def list_cafes_api():
+    """ Return a page of cafes, sorted by name or by most liked.
+        Accepts URL query string:
+            "/api/cafes?sort=name|popular&after=<cursor>&limit=<int>"
+        Returns JSON: {"cafes": [{id, name, ...}, ...],
+                       "next": <cursor (str)> | null}
+
+    If the sort, cursor or limit is invalid, return JSON with status 400:
+        {"error": "Invalid sort"}, {"error": "Invalid cursor"}
+        or {"error": "Invalid limit"}
+
+    Sends an ETag; returns 304 if the client has this page already.
+    """
+
+    limit = request.args.get("limit", str(CAFES_PER_PAGE))
+    sort = request.args.get("sort", "name")
+
+    if not limit.isdigit() or not 1 <= int(limit) <= MAX_CAFES_PER_PAGE:
+        return jsonify({"error": "Invalid limit"}), 400
+
+    if sort not in CAFE_SORTS:
+        return jsonify({"error": "Invalid sort"}), 400
+
+    limit = int(limit)
+
+    response = not_modified(make_etag(*get_cafes_validator(likes=True)))
+
+    if response:
+        return response
+
+    try:
+        cafes, next_cursor = Cafe.get_page(
+            request.args.get("after"), limit, sort=sort)
+    except InvalidCursor:
+        return jsonify({"error": "Invalid cursor"}), 400
+
+    return jsonify({
+        "cafes": [cafe.serialize() for cafe in cafes],
+        "next": next_cursor,
+    })
+
+#######################################
+# user state API
+
+
+@bp.get('/api/me/state')
+def user_state_api():
+    """ Return what's particular to the current user on shared pages (see
+    SHARED_PAGES), all in one request.
+        Accepts URL query string: "/api/me/state?cafe_ids=<id>,<id>,..."
+        Returns JSON: {"user": {"id", "username", "full_name", "admin"}
+                               | null,
+                       "likes": {"<cafe_id>": true|false, ...},
+                       "flashes": [[<category>, <message>], ...],
+                       "csrf_token": <token for forms, e.g. logging out>}
+
+    Flashed messages are returned only once, as if shown on a page. If
+    cafe_ids is invalid, return JSON with status 400:
+        {"error": "Invalid cafe_ids"}
+    """
+
+    cafe_ids = parse_cafe_ids(
+        [i for i in request.args.get("cafe_ids", "").split(",") if i])
+
+    if cafe_ids is None:
+        return jsonify({"error": "Invalid cafe_ids"}), 400
+
+    user = g.session_user
+    liked = set()
+
+    if user and cafe_ids:
+        liked = Like.liked_among(user.id, cafe_ids)
+
+    response = jsonify({
+        "user": {
+            "id": user.id,
+            "username": user.username,
+            "full_name": user.get_full_name(),
+            "admin": user.admin,
+        } if user else None,
+        "likes": {str(cafe_id): cafe_id in liked for cafe_id in cafe_ids},
+        "flashes": get_flashed_messages(with_categories=True),
+        "csrf_token": generate_csrf(),
+    })
+    response.cache_control.no_store = True
+    response.cache_control.private = True
+
+    return response
+
 
 #######################################
 # likes API
 
 
-@app.get('/api/likes')
+def parse_cafe_ids(cafe_ids):
+    """Return list of int cafe ids from a list of ids (ints or strings).
+
+    Returns None if any id isn't an int, or there are more than
+    MAX_LIKES_BATCH ids.
+    """
+
+    if not isinstance(cafe_ids, list) or len(cafe_ids) > MAX_LIKES_BATCH:
+        return None
+
+    try:
+        return [int(cafe_id) for cafe_id in cafe_ids]
+    except (TypeError, ValueError):
+        return None
+
+
+def likes_for_cafe_ids(cafe_ids):
+    """Return JSON response of the current user's likes for these ids."""
+
+    cafe_ids = parse_cafe_ids(cafe_ids)
+
+    if cafe_ids is None:
+        return jsonify({"error": "Invalid cafe_ids"}), 400
+
+    likes = g.user.likes_cafes(cafe_ids)
+
+    return jsonify({"likes": {str(k): v for k, v in likes.items()}})
+
+
+@bp.get('/api/likes')
 def check_if_like():
-    """ Determine if the current user likes a cafe.
+    """ Determine if the current user likes a cafe, or many cafes.
         Accepts URL query string: "/api/likes?cafe_id=<cafe_id>"
         Returns JSON: {"likes": true|false}
 
+        Or URL query string: "/api/likes?cafe_ids=<id>,<id>,..."
+        Returns JSON: {"likes": {"<cafe_id>": true|false, ...}}
+        (At most MAX_LIKES_BATCH ids; else returns JSON with status 400:
+        {"error": "Invalid cafe_ids"})
+
     If not logged in, return JSON: {"error": "Not logged in"}
     """
 
     if g.user:
 
+        if "cafe_ids" in request.args:
+            cafe_ids = request.args["cafe_ids"].split(",")
+            return likes_for_cafe_ids([i for i in cafe_ids if i])
+
         cafe_id = int(request.args["cafe_id"])
-        user_likes = [cafe.id for cafe in g.user.liked_cafes]
-        likes_cafe = cafe_id in user_likes
 
-        return jsonify({"likes": likes_cafe})
+        return jsonify({"likes": g.user.likes_cafe(cafe_id)})
+
+    else:
+
+        return jsonify({"error": "Not logged in"})
+
+
+@bp.post('/api/likes')
+def check_if_likes():
+    """ Determine if the current user likes each of many cafes; for lists
+        too long for a query string.
+        Accepts JSON: {"cafe_ids": [<cafe_id (int)>, ...]}
+        Returns JSON: {"likes": {"<cafe_id>": true|false, ...}}
+        (At most MAX_LIKES_BATCH ids; else returns JSON with status 400:
+        {"error": "Invalid cafe_ids"})
+
+    If not logged in, return JSON: {"error": "Not logged in"}
+    """
+
+    if g.user:
+
+        data = request.get_json(silent=True)
+
+        if not isinstance(data, dict):
+            return jsonify({"error": "Invalid cafe_ids"}), 400
+
+        return likes_for_cafe_ids(data.get("cafe_ids"))
 
     else:
 
         return jsonify({"error": "Not logged in"})
 
 
-@app.post('/api/like')
+@bp.post('/api/like')
 def add_like():
     """ Make the current user like a cafe.
         Accepts JSON: {"cafe_id": <cafe_id (int)>}
@@ -569,19 +1246,16 @@ def add_like():
             If previously not liked: {"liked": <cafe_id (int)>}
             If already liked: {"error": "Already in likes."}
     If not logged in, return JSON: {"error": "Not logged in"}
+    If no such cafe, 404.
     """
 
     if g.user:
 
         cafe_id = int(request.json["cafe_id"])
-        cafe = Cafe.query.get_or_404(cafe_id)
-        g.user.liked_cafes.append(cafe)
-
-        try:
-            db.session.commit()
+        added = add_like_or_404(cafe_id)
+        db.session.commit()
 
-        except IntegrityError:
-            db.session.rollback()
+        if not added:
             return jsonify({"error": "Already in likes."})
 
         return jsonify({"liked": cafe_id})
@@ -591,7 +1265,7 @@ def add_like():
         return jsonify({"error": "Not logged in"})
 
 
-@app.post('/api/unlike')
+@bp.post('/api/unlike')
 def remove_like():
     """ Make the current user unlike a cafe.
         Accepts JSON: {"cafe_id": <cafe_id (int)>}
@@ -605,14 +1279,10 @@ def remove_like():
     if g.user:
 
         cafe_id = int(request.json["cafe_id"])
-        cafe = Cafe.query.get_or_404(cafe_id)
-
-        try:
-            g.user.liked_cafes.remove(cafe)
-            db.session.commit()
+        removed = Like.remove(g.user.id, cafe_id)
+        db.session.commit()
 
-        except ValueError:
-            db.session.rollback()
+        if not removed:
             return jsonify({"error": "Not in your likes."})
 
         return jsonify({"unliked": cafe_id})
@@ -620,3 +1290,58 @@ def remove_like():
     else:
 
         return jsonify({"error": "Not logged in"})
+
+
+def add_like_or_404(cafe_id):
+    """Make the current user like a cafe; 404 if there's no such cafe.
+
+    Returns True if a like was added, False if it already existed.
+    """
+
+    try:
+        return Like.add(g.user.id, cafe_id)
+
+    except IntegrityError:
+        # foreign key violation: no cafe with this id
+        db.session.rollback()
+        abort(404)
+
+
+@bp.route('/api/cafes/<int:cafe_id>/like', methods=["PUT", "DELETE"])
+def set_like(cafe_id):
+    """ Set whether the current user likes a cafe; safe to repeat.
+        PUT likes the cafe, DELETE unlikes it.
+        Returns JSON:
+            {"cafe_id": <cafe_id (int)>,
+             "liked": true|false,
+             "like_count": <number of users who like the cafe (int)>}
+
+    If not logged in, return JSON: {"error": "Not logged in"}
+    If the cafe doesn't exist, 404.
+    """
+
+    if g.user:
+
+        liked = request.method == "PUT"
+
+        if liked:
+            add_like_or_404(cafe_id)
+        else:
+            Like.remove(g.user.id, cafe_id)
+
+        db.session.commit()
+
+        like_count = Like.count_for(cafe_id)
+
+        if like_count is None:
+            abort(404)
+
+        return jsonify({
+            "cafe_id": cafe_id,
+            "liked": liked,
+            "like_count": like_count,
+        })
+
+    else:
+
+        return jsonify({"error": "Not logged in"})
@@ -0,0 +1,281 @@
+"""Benchmarks for Flask Cafe.
+
+These drop and recreate every table, so they always run against their own
+database (BENCH_DATABASE_URL, default flaskcafe_bench):
+
+    createdb flaskcafe_bench
+    python benchmarks.py likes
+"""
+
+import argparse
+import os
+from contextlib import redirect_stdout
+import statistics
+import threading
+import time
+
+from flask import g
+
+os.environ["DATABASE_URL"] = os.environ.get(
+    "BENCH_DATABASE_URL", "postgresql:///flaskcafe_bench")
+
+from app import create_app, CURR_USER_KEY
+from hashing import password_hasher, HasherBusy
+from models import db, Cafe, City, User
+
+app = create_app("testing")
+app.app_context().push()
+
+
+#######################################
+# helpers
+
+
+def reset_db():
+    """Recreate all tables with a city and a user; return the user's id."""
+
+    db.session.remove()
+    db.drop_all()
+    db.create_all()
+
+    db.session.add(City(code="sf", name="San Francisco", state="CA"))
+    user = User.register(username="bench",
+                         password="secret",
+                         first_name="Bench",
+                         last_name="Mark",
+                         email="bench@test.com")
+    db.session.add(user)
+    db.session.commit()
+
+    return user.id
+
+
+def add_cafes(n):
+    """Add n cafes; return list of their ids."""
+
+    cafes = [Cafe(name=f"Cafe {i:05}", address=f"{i} Main St", city_code="sf")
+             for i in range(n)]
+    db.session.add_all(cafes)
+    db.session.commit()
+
+    return [cafe.id for cafe in cafes]
+
+
+def logged_in_client(user_id, app=app):
+    """Return a test client logged in as this user."""
+
+    client = app.test_client()
+
+    with client.session_transaction() as sess:
+        sess[CURR_USER_KEY] = user_id
+
+    return client
+
+
+def timed(fn, repeat):
+    """Run fn repeat times; return best wall time in seconds."""
+
+    best = float("inf")
+
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+
+    return best
+
+
+def report(title, rows):
+    """Print a small table of (label, seconds) rows."""
+
+    print(f"\n{title}")
+    for label, seconds in rows:
+        print(f"  {label:<40} {seconds * 1000:10.2f} ms")
+
+
+#######################################
+# benchmarks
+
+
+def bench_likes(n_cafes=300, repeat=5):
+    """Like status for a page of cafes: one request per id vs one batch."""
+
+    user_id = reset_db()
+    cafe_ids = add_cafes(n_cafes)
+
+    user = db.session.get(User, user_id)
+    user.liked_cafes.extend(Cafe.query.filter(Cafe.id.in_(cafe_ids[::2])))
+    db.session.commit()
+
+    client = logged_in_client(user_id)
+
+    def per_id():
+        for cafe_id in cafe_ids:
+            client.get("/api/likes", query_string={"cafe_id": cafe_id})
+
+    def batch():
+        client.post("/api/likes", json={"cafe_ids": cafe_ids})
+
+    report(f"like status for {n_cafes} cafes (best of {repeat})", [
+        ("GET /api/likes?cafe_id=... per cafe", timed(per_id, repeat)),
+        ("POST /api/likes (one batch)", timed(batch, repeat)),
+    ])
+
+
+def bench_csrf(n_requests=500, repeat=5):
+    """Per-request cost of building g.csrf_form eagerly (as every request
+    used to) vs. lazily, on API routes that never use it.
+    """
+
+    user_id = reset_db()
+    cafe_id = add_cafes(1)[0]
+    client = logged_in_client(user_id)
+    app.config['WTF_CSRF_ENABLED'] = True
+
+    def build_csrf_form():
+        # Flask-WTF keeps the token on g, which is per-request in a server
+        # but outlives requests here (an app context is pushed above)
+        g.pop("csrf_token", None)
+        g.csrf_form._get_current_object()
+
+    def requests():
+        for _ in range(n_requests):
+            client.get("/api/likes", query_string={"cafe_id": cafe_id})
+            client.get("/api/cafes", query_string={"limit": 1})
+
+    lazy = timed(requests, repeat)
+
+    app.before_request_funcs[None].append(build_csrf_form)
+    try:
+        eager = timed(requests, repeat)
+    finally:
+        app.before_request_funcs[None].remove(build_csrf_form)
+        app.config['WTF_CSRF_ENABLED'] = False
+
+    per_request = 1000 / (2 * n_requests)
+    report(f"{2 * n_requests} /api/* requests (best of {repeat})", [
+        ("CSRF form built every request", eager),
+        ("CSRF form built on first use", lazy),
+    ])
+    print(f"  saved per request: {(eager - lazy) * per_request * 1000:.1f} µs")
+
+
+def bench_login_pool(n_threads=16, seconds=5, pool_size=2):
+    """Login throughput, and latency of a cheap page, while n_threads log in
+    as fast as they can: bcrypt on the request threads vs. in a pool.
+    """
+
+    reset_db()
+    add_cafes(1)
+    hashed = password_hasher.hash("secret")
+
+    def run(pool_size):
+        app.config['BCRYPT_POOL_SIZE'] = pool_size
+        app.config['BCRYPT_POOL_MAX_PENDING'] = 2 * pool_size
+        password_hasher.init_app(app)
+
+        stop = time.monotonic() + seconds
+        counts = {"logins": 0, "rejected": 0}
+        lock = threading.Lock()
+        latencies = []
+
+        def log_in():
+            while time.monotonic() < stop:
+                try:
+                    password_hasher.check(hashed, "secret")
+                    outcome = "logins"
+                except HasherBusy:
+                    outcome = "rejected"
+                    # a turned-away client waits a little before retrying
+                    time.sleep(.01)
+                with lock:
+                    counts[outcome] += 1
+
+        def view_pages():
+            client = app.test_client()
+            while time.monotonic() < stop:
+                start = time.perf_counter()
+                client.get("/api/cafes", query_string={"limit": 1})
+                latencies.append(time.perf_counter() - start)
+
+        threads = [threading.Thread(target=log_in) for _ in range(n_threads)]
+        threads.append(threading.Thread(target=view_pages))
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        password_hasher.shutdown()
+        latencies.sort()
+        p95 = latencies[int(len(latencies) * .95)]
+
+        label = f"pool of {pool_size}" if pool_size else "request threads"
+        print(f"  {label:<16} {counts['logins'] / seconds:8.1f} logins/s"
+              f" {counts['rejected'] / seconds:8.1f} rejected/s"
+              f"   page p50 {statistics.median(latencies) * 1000:6.2f} ms"
+              f"  p95 {p95 * 1000:6.2f} ms")
+
+    print(f"\n{n_threads} threads logging in for {seconds}s each "
+          f"(work factor {password_hasher.work_factor}, {os.cpu_count()} CPUs)")
+    run(0)
+    run(pool_size)
+
+
+def bench_profiles(n_requests=200, repeat=3):
+    """Per-request cost of the development profile (SQL echo & debug
+    toolbar) vs. production, for the cafe list page and an API route.
+    """
+
+    user_id = reset_db()
+    add_cafes(50)
+
+    def run(config_name):
+        # SQL echo logs to the stdout the engine was made with; still pay
+        # for it, but out of sight
+        with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+            profile_app = create_app(config_name)
+
+            with profile_app.app_context():
+                client = logged_in_client(user_id, profile_app)
+
+                def requests():
+                    for _ in range(n_requests):
+                        client.get("/cafes")
+                        client.get("/api/cafes", query_string={"limit": 24})
+
+                return timed(requests, repeat)
+
+    development = run("development")
+    production = run("production")
+
+    per_request = 1000 / (2 * n_requests)
+    report(f"{2 * n_requests} requests, /cafes & /api/cafes "
+           f"(best of {repeat})", [
+               ("development profile", development),
+               ("production profile", production),
+           ])
+    print(f"  saved per request: "
+          f"{(development - production) * per_request:.2f} ms")
+
+
+BENCHMARKS = {
+    "likes": bench_likes,
+    "csrf": bench_csrf,
+    "login-pool": bench_login_pool,
+    "profiles": bench_profiles,
+}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("names", nargs="*", metavar="name",
+                        help=f"benchmarks to run: {', '.join(BENCHMARKS)} "
+                             "(default: all)")
+    args = parser.parse_args()
+
+    for name in args.names:
+        if name not in BENCHMARKS:
+            parser.error(f"unknown benchmark: {name}")
+
+    for name in args.names or BENCHMARKS:
+        BENCHMARKS[name]()
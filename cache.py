@@ -0,0 +1,516 @@
+"""Caches for Flask Cafe."""
+
+import fcntl
+import hashlib
+import os
+import pickle
+import random
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from metrics import metrics
+
+
+class TTLCache:
+    """Thread-safe LRU cache whose entries expire ttl seconds after being set.
+
+    Holds at most maxsize entries, dropping the least recently used first.
+    A ttl of 0 (or less) turns the cache off: nothing is kept.
+    """
+
+    def __init__(self, maxsize=1024, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        """Return value for key, or default if missing or expired."""
+
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is None:
+                return default
+
+            expires, value = entry
+
+            if expires <= time.monotonic():
+                del self._entries[key]
+                return default
+
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        """Store value for key, for ttl seconds (default: the cache's ttl)."""
+
+        ttl = self.ttl if ttl is None else ttl
+
+        if ttl <= 0:
+            return
+
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, value)
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        """Remove key, if present."""
+
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        """Remove everything."""
+
+        with self._lock:
+            self._entries.clear()
+
+
+#######################################
+# tagged cache
+
+# tag versions live this long; an entry whose tag version has gone counts
+# as invalidated
+TAG_TTL = 24 * 60 * 60
+
+# most tag versions kept in memory; they're kept apart from entries, so
+# entries coming and going don't push them out
+TAG_MAXSIZE = 65536
+
+_MISSING = object()
+
+
+class MemoryBackend:
+    """Cache entries in this process only, in a TTLCache."""
+
+    def __init__(self, maxsize=1024):
+        self._entries = TTLCache(maxsize=maxsize)
+
+    def get(self, key):
+        """Return value for key, or None."""
+
+        return self._entries.get(key)
+
+    def get_many(self, keys):
+        """Return dict of key -> value for the keys that have one."""
+
+        found = {key: self._entries.get(key, _MISSING) for key in keys}
+        return {key: value for key, value in found.items()
+                if value is not _MISSING}
+
+    def set(self, key, value, ttl):
+        self._entries.set(key, value, ttl)
+
+    def clear(self):
+        self._entries.clear()
+
+
+class SQLiteBackend:
+    """Cache entries (pickled) in an SQLite file, shared by every worker
+    process on this host that uses the same path.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+        with self._connect() as conn:
+            conn.execute("""CREATE TABLE IF NOT EXISTS cache (
+                                key TEXT PRIMARY KEY,
+                                value BLOB NOT NULL,
+                                expires REAL NOT NULL)""")
+
+    def get(self, key):
+        """Return value for key, or None."""
+
+        return self.get_many([key]).get(key)
+
+    def get_many(self, keys):
+        """Return dict of key -> value for the keys that have one."""
+
+        keys = list(keys)
+
+        if not keys:
+            return {}
+
+        placeholders = ", ".join("?" * len(keys))
+        rows = self._connect().execute(
+            f"SELECT key, value FROM cache "
+            f"WHERE key IN ({placeholders}) AND expires > ?",
+            (*keys, time.time()))
+
+        return {key: pickle.loads(value) for key, value in rows}
+
+    def set(self, key, value, ttl):
+        now = time.time()
+        conn = self._connect()
+
+        conn.execute("INSERT OR REPLACE INTO cache VALUES (?, ?, ?)",
+                     (key, pickle.dumps(value), now + ttl))
+
+        # now & then, drop what's expired
+        if random.random() < .01:
+            conn.execute("DELETE FROM cache WHERE expires <= ?", (now,))
+
+    def clear(self):
+        self._connect().execute("DELETE FROM cache")
+
+    def _connect(self):
+        """Return this thread's connection (in autocommit mode)."""
+
+        conn = getattr(self._local, "conn", None)
+
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5,
+                                   isolation_level=None)
+            self._local.conn = conn
+
+        return conn
+
+
+def make_backend(storage, maxsize=1024):
+    """Return backend for a storage setting: "memory" or "sqlite:///path"."""
+
+    if storage == "memory":
+        return MemoryBackend(maxsize)
+
+    if storage.startswith("sqlite:///"):
+        return SQLiteBackend(storage[len("sqlite:///"):])
+
+    raise ValueError(f"Unknown cache storage: {storage}")
+
+
+# lock files in a SingleFlight's lock_dir: keys share them by hash, so
+# there are never more than this, whatever the keys
+LOCK_STRIPES = 256
+
+
+class SingleFlight:
+    """Lets one caller at a time work on a key (e.g. render a page that's
+    not cached), so concurrent callers can wait for its result instead of
+    all doing the same work.
+
+    Within this process, there's a lock per key; across processes on this
+    host, if lock_dir is set, an flock on one of LOCK_STRIPES lock files in
+    it too (so keys sharing a file also wait for each other, briefly).
+    Waiting gives up after timeout seconds.
+    """
+
+    def __init__(self, lock_dir=None, timeout=10):
+        self.lock_dir = lock_dir
+        self.timeout = timeout
+        # key -> [lock, number of callers using it]
+        self._locks = {}
+        self._guard = threading.Lock()
+
+        if lock_dir is not None:
+            os.makedirs(lock_dir, exist_ok=True)
+
+    @contextmanager
+    def hold(self, key, blocking=True):
+        """Hold key's lock for the block. Yields True, or False if it's
+        held elsewhere and not blocking (or waiting timed out).
+        """
+
+        with self._guard:
+            entry = self._locks.setdefault(key, [threading.Lock(), 0])
+            entry[1] += 1
+
+        lock = entry[0]
+
+        try:
+            if not lock.acquire(blocking, self.timeout if blocking else -1):
+                yield False
+                return
+
+            try:
+                with self._hold_file(key, blocking) as holding:
+                    yield holding
+            finally:
+                lock.release()
+        finally:
+            with self._guard:
+                entry[1] -= 1
+
+                if not entry[1]:
+                    del self._locks[key]
+
+    @contextmanager
+    def _hold_file(self, key, blocking):
+        """Hold key's lock file (if there's a lock_dir) for the block."""
+
+        if self.lock_dir is None:
+            yield True
+            return
+
+        stripe = int(hashlib.sha1(key.encode()).hexdigest(), 16) % LOCK_STRIPES
+        path = os.path.join(self.lock_dir, f"stripe-{stripe}.lock")
+        deadline = time.monotonic() + self.timeout
+
+        with open(path, "a") as file:
+            while True:
+                try:
+                    fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    if not blocking or time.monotonic() > deadline:
+                        yield False
+                        return
+
+                    time.sleep(.01)
+
+            try:
+                yield True
+            finally:
+                fcntl.flock(file, fcntl.LOCK_UN)
+
+
+class TaggedCache:
+    """Cache whose entries are tagged (e.g. "cafe:3", "cafe-list"), so all
+    entries about something can be dropped at once with invalidate(tag).
+
+    Each tag has a version (a random token) in the tag backend, changed by
+    invalidate; entries keep the versions of their tags from when they were
+    made, and are invalidated once any of those has changed.
+
+    Entries expire after CACHE_TTL seconds, but get_or_set serves them for
+    CACHE_STALE_TTL seconds more while one caller makes them again. A
+    missing entry is made by one caller at a time, too (see SingleFlight):
+    others wait for it rather than repeating the work.
+
+    Config:
+        CACHE_STORAGE: "memory" (the default; per process) or
+            "sqlite:///path/to/file.db" (shared by workers on this host,
+            which then also share the work of making entries, using lock
+            files in "<file>.db-locks/")
+        CACHE_TTL: seconds entries are fresh (default 300; 0 turns the cache
+            off)
+        CACHE_STALE_TTL: seconds expired entries may still be served
+            (default 60)
+        CACHE_MAXSIZE: most entries kept in memory (default 1024)
+    """
+
+    def __init__(self, app=None):
+        self.storage = "memory"
+        self.maxsize = 1024
+        self.ttl = 300
+        self.stale_ttl = 60
+        self.backend = MemoryBackend()
+        self.tag_backend = MemoryBackend(TAG_MAXSIZE)
+        self.single_flight = SingleFlight()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Configure from this Flask app's config."""
+
+        self.storage = app.config.get('CACHE_STORAGE', "memory")
+        self.maxsize = app.config.get('CACHE_MAXSIZE', 1024)
+        self.ttl = app.config.get('CACHE_TTL', 300)
+        self.stale_ttl = app.config.get('CACHE_STALE_TTL', 60)
+        self.backend, self.tag_backend = self._make_backends()
+        self.single_flight = self._make_single_flight()
+
+        app.extensions['page_cache'] = self
+
+    def get(self, key, default=None):
+        """Return value for key, or default if missing, expired or
+        invalidated.
+        """
+
+        found = self._lookup(key)
+
+        if found is not None and found[1]:
+            metrics.incr("cache.hit")
+            return found[0]
+
+        metrics.incr("cache.miss")
+        return default
+
+    def get_many(self, keys):
+        """Return dict of key -> value for the keys that have a fresh one."""
+
+        keys = list(keys)
+        now = time.time()
+        entries = {key: entry
+                   for key, entry in self.backend.get_many(keys).items()
+                   if entry[2] > now}
+        tags = {tag for value, versions, fresh_until in entries.values()
+                for tag in versions}
+        current = self._versions(tags, create=False)
+        found = {key: value
+                 for key, (value, versions, fresh_until) in entries.items()
+                 if all(current.get(tag) == version
+                        for tag, version in versions.items())}
+
+        metrics.incr("cache.hit", len(found))
+        metrics.incr("cache.miss", len(keys) - len(found))
+        return found
+
+    def get_or_set(self, key, make, tags=(), more_tags=None, ttl=None):
+        """Return value for key; if missing, expired or invalidated, return
+        make() and store it (unless it's None) with these tags.
+
+        One caller at a time calls make for a key. Callers finding the
+        entry expired get it anyway while that's done; callers finding none
+        wait, then use the one made.
+
+        The versions of tags are read before calling make, so an
+        invalidation while it runs isn't missed. more_tags(value) can
+        return tags only known from the value.
+        """
+
+        found = self._lookup(key)
+
+        if found is not None:
+            value, fresh = found
+
+            if fresh:
+                metrics.incr("cache.hit")
+                return value
+
+            with self.single_flight.hold(key, blocking=False) as holding:
+                if holding:
+                    return self._make(key, make, tags, more_tags, ttl)
+
+            metrics.incr("cache.stale")
+            return value
+
+        metrics.incr("cache.miss")
+
+        with self.single_flight.hold(key) as holding:
+            if holding:
+                # made by another caller while we waited?
+                found = self._lookup(key)
+
+                if found is not None and found[1]:
+                    metrics.incr("cache.coalesced")
+                    return found[0]
+
+            return self._make(key, make, tags, more_tags, ttl)
+
+    def set(self, key, value, tags=(), ttl=None):
+        """Store value for key with these tags."""
+
+        self._store(key, value, self._versions(tags), ttl)
+
+    def invalidate(self, *tags):
+        """Make every entry with any of these tags stale."""
+
+        for tag in tags:
+            self.tag_backend.set(f"tag:{tag}", uuid.uuid4().hex, TAG_TTL)
+
+        metrics.incr("cache.invalidated", len(tags))
+
+    def clear(self):
+        """Remove everything."""
+
+        self.backend.clear()
+        self.tag_backend.clear()
+
+    def after_fork(self):
+        """Start over with backends & locks of our own (call in a forked
+        child): SQLite connections can't be shared with the parent, and the
+        parent's threads may hold locks.
+        """
+
+        self.backend, self.tag_backend = self._make_backends()
+        self.single_flight = self._make_single_flight()
+
+    def _make_backends(self):
+        """Return (backend, tag backend) for this storage. In memory, tag
+        versions get a cache of their own; SQLite keeps every entry until
+        it expires, so they can share it.
+        """
+
+        backend = make_backend(self.storage, self.maxsize)
+
+        if isinstance(backend, MemoryBackend):
+            return backend, MemoryBackend(TAG_MAXSIZE)
+
+        return backend, backend
+
+    def _make_single_flight(self):
+        """SingleFlight for this storage: locking across processes only if
+        they share entries.
+        """
+
+        if self.storage.startswith("sqlite:///"):
+            return SingleFlight(f"{self.storage[len('sqlite:///'):]}-locks")
+
+        return SingleFlight()
+
+    def _lookup(self, key):
+        """Return (value, fresh?) for key, or None if it's missing or
+        invalidated.
+        """
+
+        entry = self.backend.get(key)
+
+        if entry is None:
+            return None
+
+        value, versions, fresh_until = entry
+
+        if self._versions(versions, create=False) != versions:
+            return None
+
+        return value, fresh_until > time.time()
+
+    def _make(self, key, make, tags, more_tags, ttl):
+        """Return make(), storing it for key (see get_or_set)."""
+
+        versions = self._versions(tags)
+        value = make()
+
+        if value is not None:
+            if more_tags:
+                versions.update(self._versions(more_tags(value)))
+            self._store(key, value, versions, ttl)
+
+        return value
+
+    def _store(self, key, value, versions, ttl):
+        """Store entry, fresh for ttl seconds & kept stale_ttl more."""
+
+        ttl = self.ttl if ttl is None else ttl
+
+        if ttl > 0:
+            self.backend.set(key, (value, versions, time.time() + ttl),
+                             ttl + self.stale_ttl)
+
+    def _versions(self, tags, create=True):
+        """Return dict of tag -> current version. Tags with no version are
+        given one if create, else left out.
+        """
+
+        tags = list(tags)
+        found = self.tag_backend.get_many(f"tag:{tag}" for tag in tags)
+        versions = {}
+
+        for tag in tags:
+            version = found.get(f"tag:{tag}")
+
+            if version is None and create:
+                version = uuid.uuid4().hex
+                self.tag_backend.set(f"tag:{tag}", version, TAG_TTL)
+
+            if version is not None:
+                versions[tag] = version
+
+        return versions
+
+
+page_cache = TaggedCache()
@@ -0,0 +1,132 @@
+"""Configuration profiles for Flask Cafe.
+
+create_app(config_name) picks one of CONFIGS; secrets & URLs come from the
+environment (or a .env file).
+"""
+
+import os
+from dotenv import load_dotenv
+
+from hashing import DEFAULT_WORK_FACTOR
+from pooling import engine_options
+
+load_dotenv()
+
+
+class Config:
+    """Settings shared by every profile."""
+
+    SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL')
+    SECRET_KEY = os.environ.get('SECRET_KEY')
+    SQLALCHEMY_ECHO = False
+    SQLALCHEMY_ENGINE_OPTIONS = engine_options()
+    # a read replica (e.g. a streaming standby) for GET requests' reads
+    SQLALCHEMY_BINDS = (
+        {"replica": os.environ['DATABASE_REPLICA_URL']}
+        if os.environ.get('DATABASE_REPLICA_URL') else {})
+    # seconds a browser reads from the primary after writing (longer than
+    # the replica usually lags)
+    REPLICA_STICKY_SECONDS = int(os.environ.get('REPLICA_STICKY_SECONDS', 5))
+    DEBUG_TB_ENABLED = False
+    # proxies in front of the app (e.g. nginx and a CDN: 2) that add
+    # X-Forwarded-For/-Proto, so the client IP is read from those rather
+    # than being the nearest proxy's; 0 trusts no forwarded headers
+    TRUSTED_PROXY_HOPS = int(os.environ.get('TRUSTED_PROXY_HOPS', 0))
+    # this release (e.g. its git commit), part of every ETag so pages are
+    # refetched after a deploy
+    RELEASE = os.environ.get('RELEASE', "")
+    # render cafe pages the same for everyone, with the user's part filled
+    # in by the browser (from /api/me/state), so shared caches such as a
+    # CDN can keep them for SHARED_PAGE_MAX_AGE seconds
+    SHARED_PAGES = os.environ.get('SHARED_PAGES', "") not in ("", "0")
+    SHARED_PAGE_MAX_AGE = int(os.environ.get('SHARED_PAGE_MAX_AGE', 60))
+    # DEBUG_TB_INTERCEPT_REDIRECTS = False
+
+    # seconds a loaded user is reused across requests (0 turns this off)
+    USER_CACHE_TTL = int(os.environ.get('USER_CACHE_TTL', 30))
+
+    # cached cafe pages & fragments (see cache.TaggedCache): seconds fresh
+    # (0 turns this off) & then served while remade, most kept in memory, &
+    # storage ("sqlite:///file" shares them between workers on a host)
+    CACHE_TTL = int(os.environ.get('CACHE_TTL', 300))
+    CACHE_STALE_TTL = int(os.environ.get('CACHE_STALE_TTL', 60))
+    CACHE_MAXSIZE = 1024
+    CACHE_STORAGE = os.environ.get('CACHE_STORAGE', "memory")
+
+    # bcrypt work factor for new hashes; older ones are upgraded on login
+    BCRYPT_WORK_FACTOR = int(
+        os.environ.get('BCRYPT_WORK_FACTOR', DEFAULT_WORK_FACTOR))
+    # bcrypt worker processes (0: hash on the request thread) & their
+    # queue limit
+    BCRYPT_POOL_SIZE = int(os.environ.get('BCRYPT_POOL_SIZE', 0))
+    BCRYPT_POOL_MAX_PENDING = int(
+        os.environ.get('BCRYPT_POOL_MAX_PENDING', 16))
+    # most background re-hashes (work factor upgrades) queued at once;
+    # past it, upgrades wait for the user's next login
+    BCRYPT_BACKGROUND_MAX_PENDING = int(
+        os.environ.get('BCRYPT_BACKGROUND_MAX_PENDING', 4))
+
+    # login attempts allowed in a row per username / per IP, & the seconds
+    # it takes to earn them all back; storage "sqlite:///file" shares them
+    # between workers on a host
+    LOGIN_RATE_LIMIT_STORAGE = os.environ.get(
+        'LOGIN_RATE_LIMIT_STORAGE', "memory")
+    LOGIN_USERNAME_BURST = 5
+    LOGIN_IP_BURST = 20
+    LOGIN_RATE_PERIOD = 300
+
+
+class DevelopmentConfig(Config):
+    """Local development: every SQL statement logged, debug toolbar on."""
+
+    SQLALCHEMY_ECHO = True
+    DEBUG_TB_ENABLED = True
+
+
+class TestingConfig(Config):
+    """Running tests.py."""
+
+    # Make Flask errors be real errors, rather than HTML pages with error info
+    TESTING = True
+
+    # Don't req CSRF for testing
+    WTF_CSRF_ENABLED = False
+
+
+class ProductionConfig(Config):
+    """Serving real traffic: no SQL logging or toolbar, and a database
+    connection pool sized for the number of request threads per worker.
+
+    DB_PGBOUNCER=1 leaves pooling to PgBouncer (see pooling.engine_options).
+    """
+
+    SQLALCHEMY_ENGINE_OPTIONS = engine_options(
+        pool_size=int(os.environ.get('DB_POOL_SIZE', 5)),
+        max_overflow=int(os.environ.get('DB_MAX_OVERFLOW', 5)),
+        # seconds to wait for a free connection before erroring
+        pool_timeout=int(os.environ.get('DB_POOL_TIMEOUT', 10)),
+        # replace connections before the server (or a proxy) drops them
+        pool_recycle=int(os.environ.get('DB_POOL_RECYCLE', 1800)),
+        pre_ping=True,
+        pgbouncer=os.environ.get('DB_PGBOUNCER', "") not in ("", "0"),
+    )
+
+
+CONFIGS = {
+    "development": DevelopmentConfig,
+    "testing": TestingConfig,
+    "production": ProductionConfig,
+}
+
+
+def get_config(config_name=None):
+    """Return config class for this name (default: FLASK_CONFIG env var, or
+    "development").
+    """
+
+    config_name = config_name or os.environ.get('FLASK_CONFIG', "development")
+
+    try:
+        return CONFIGS[config_name]
+    except KeyError:
+        raise ValueError(f"Unknown config: {config_name}")
@@ -0,0 +1,26 @@
+"""Gunicorn settings for Flask Cafe (see wsgi.py)."""
+
+import gc
+import os
+
+bind = os.environ.get("BIND", "0.0.0.0:8000")
+workers = int(os.environ.get("WEB_CONCURRENCY", 2 * os.cpu_count() + 1))
+# keep DB_POOL_SIZE + DB_MAX_OVERFLOW at or above threads per worker
+threads = int(os.environ.get("GUNICORN_THREADS", 1))
+
+# import wsgi:app once, in the parent, before forking workers
+preload_app = True
+
+
+def pre_fork(server, worker):
+    # move everything loaded so far out of the garbage collector's reach:
+    # otherwise its bookkeeping writes to every object, copying the pages
+    # workers would have shared with the parent
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    from app import after_fork
+    from wsgi import app
+
+    after_fork(app)
@@ -0,0 +1,336 @@
+"""Password hashing for Flask Cafe, off the request thread.
+
+bcrypt is deliberately slow and CPU-bound. With a pool configured, hashes
+run in a bounded pool of worker processes, so a burst of logins can use at
+most BCRYPT_POOL_SIZE CPUs; past BCRYPT_POOL_MAX_PENDING queued hashes,
+new ones fail fast with HasherBusy instead of piling up. If a worker process
+dies (e.g. killed for lack of memory), the hashes it takes down fail with
+HasherBusy too, and the next one starts a new pool.
+"""
+
+import logging
+import multiprocessing
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import bcrypt
+
+from metrics import metrics
+
+DEFAULT_WORK_FACTOR = 9
+
+logger = logging.getLogger(__name__)
+
+
+class HasherBusy(Exception):
+    """Raised when too many password hashes are already queued."""
+
+
+def hash_password(password, rounds):
+    """Return bcrypt hash (str) of password, with this work factor."""
+
+    salt = bcrypt.gensalt(rounds)
+    return bcrypt.hashpw(password.encode('utf8'), salt).decode('utf8')
+
+
+def check_password(hashed, password):
+    """Return True if password matches this bcrypt hash."""
+
+    return bcrypt.checkpw(password.encode('utf8'), hashed.encode('utf8'))
+
+
+def get_work_factor(hashed):
+    """Return the work factor a bcrypt hash was made with.
+
+        E.g. get_work_factor('$2b$09$...') -> 9
+    """
+
+    return int(hashed.split('$')[2])
+
+
+def calibrate(target, max_work_factor=16):
+    """Time hash_password on this host at increasing work factors.
+
+    Stops after the first one slower than target seconds. Returns
+    (timings, suggested): timings is a list of (work factor, seconds);
+    suggested is the highest work factor within target (at least 4).
+    """
+
+    timings = []
+
+    for rounds in range(4, max_work_factor + 1):
+        seconds = min(_time_hash(rounds) for _ in range(3))
+        timings.append((rounds, seconds))
+
+        if seconds > target:
+            break
+
+    within = [rounds for rounds, seconds in timings if seconds <= target]
+    return timings, max(within, default=4)
+
+
+def _time_hash(rounds):
+    """Return seconds taken to hash a password at this work factor."""
+
+    start = time.perf_counter()
+    hash_password("calibrate", rounds)
+    return time.perf_counter() - start
+
+
+class PasswordHasher:
+    """Runs hash_password & check_password, in a process pool if configured.
+
+    Config:
+        BCRYPT_WORK_FACTOR: work factor for new hashes (default 9); hashes
+            made with another one should be redone (see needs_rehash)
+        BCRYPT_POOL_SIZE: worker processes (0, the default, hashes on the
+            calling thread)
+        BCRYPT_POOL_MAX_PENDING: most hashes running or queued at once
+            (default: 4 per worker)
+        BCRYPT_BACKGROUND_MAX_PENDING: most hash_in_background hashes
+            running or queued at once, pool or not (default 4)
+    """
+
+    def __init__(self, app=None):
+        self.work_factor = DEFAULT_WORK_FACTOR
+        self.pool_size = 0
+        self.max_pending = 0
+        self.background_max_pending = 4
+        self._executor = None
+        self._background = None
+        self._pending = 0
+        # keys of the hash_in_background hashes running or queued
+        self._background_keys = set()
+        self._background_pending = 0
+        self._lock = threading.Lock()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Configure from this Flask app's config."""
+
+        self.shutdown()
+        self.work_factor = app.config.get(
+            'BCRYPT_WORK_FACTOR', DEFAULT_WORK_FACTOR)
+        self.pool_size = app.config.get('BCRYPT_POOL_SIZE', 0)
+        self.max_pending = app.config.get(
+            'BCRYPT_POOL_MAX_PENDING', 4 * self.pool_size)
+        self.background_max_pending = app.config.get(
+            'BCRYPT_BACKGROUND_MAX_PENDING', 4)
+
+        app.extensions['password_hasher'] = self
+
+    def hash(self, password, rounds=None):
+        """Return bcrypt hash of password, at the configured work factor
+        unless rounds is given. Raises HasherBusy if saturated.
+        """
+
+        return self._run(hash_password, password, rounds or self.work_factor)
+
+    def check(self, hashed, password):
+        """Return True if password matches hash. Raises HasherBusy if
+        saturated.
+        """
+
+        return self._run(check_password, hashed, password)
+
+    def needs_rehash(self, hashed):
+        """Was this hash made with other than the configured work factor?"""
+
+        return get_work_factor(hashed) != self.work_factor
+
+    def hash_in_background(self, password, on_hashed, key=None):
+        """Hash password at the configured work factor without waiting for
+        it; on_hashed(hashed) is then called from a background thread.
+
+        Returns a Future for on_hashed's result, or None if it's skipped,
+        not queued: if BCRYPT_BACKGROUND_MAX_PENDING background hashes are
+        pending already, or one with this key (e.g. for the same user) is,
+        or the pool is too busy.
+
+        on_hashed runs on the background thread, not in the pool's
+        callback: that thread delivers every pooled result, so a slow
+        on_hashed (e.g. waiting for a database connection) would hold up
+        other logins' hashes.
+        """
+
+        with self._lock:
+            if (self._background_pending >= self.background_max_pending
+                    or key is not None and key in self._background_keys):
+                metrics.incr("bcrypt.background_skipped")
+                return None
+
+            self._background_pending += 1
+
+            if key is not None:
+                self._background_keys.add(key)
+
+        done = Future()
+
+        def finish(hashing):
+            # free the slot & key before resolving done, so whoever waits
+            # on it can queue another
+            try:
+                result = on_hashed(hashing.result())
+            except Exception as exc:
+                logger.exception("background password hash failed")
+                self._background_done(key)
+                done.set_exception(exc)
+            else:
+                self._background_done(key)
+                done.set_result(result)
+
+        try:
+            if self.pool_size:
+                hashing = self._submit(hash_password, password,
+                                       self.work_factor)
+            else:
+                hashing = self._get_background().submit(
+                    hash_password, password, self.work_factor)
+        except HasherBusy:
+            self._background_done(key)
+            return None
+
+        hashing.add_done_callback(
+            lambda hashing: self._get_background().submit(finish, hashing))
+        return done
+
+    def shutdown(self):
+        """Stop the worker processes & background thread, if any; they
+        restart on next use.
+        """
+
+        with self._lock:
+            executor, self._executor = self._executor, None
+            background, self._background = self._background, None
+            self._pending = 0
+            self._background_keys = set()
+            self._background_pending = 0
+
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+        if background is not None:
+            background.shutdown(wait=False)
+
+    def after_fork(self):
+        """Forget the parent's worker processes & thread (call in a forked
+        child); new ones start on first use.
+        """
+
+        self._executor = None
+        self._background = None
+        self._pending = 0
+        self._background_keys = set()
+        self._background_pending = 0
+        self._lock = threading.Lock()
+
+    def _run(self, fn, *args):
+        """Call fn(*args), in the pool if there is one; record its time.
+
+        Raises HasherBusy if the pool broke while it ran.
+        """
+
+        start = time.perf_counter()
+
+        if not self.pool_size:
+            result = fn(*args)
+        else:
+            try:
+                result = self._submit(fn, *args).result()
+            except BrokenProcessPool:
+                raise HasherBusy()
+
+        metrics.observe(f"bcrypt.{fn.__name__}", time.perf_counter() - start)
+        return result
+
+    def _submit(self, fn, *args, retry=True):
+        """Queue fn(*args) on the pool (started on first use, and again if
+        it's found broken).
+
+        Workers are started by a fork server, not forked from this process:
+        its request threads may hold locks a forked copy would never see
+        released.
+        """
+
+        with self._lock:
+            if self._pending >= self.max_pending:
+                metrics.incr("bcrypt.rejected")
+                raise HasherBusy()
+
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(
+                    self.pool_size,
+                    mp_context=multiprocessing.get_context("forkserver"))
+
+            executor = self._executor
+
+            try:
+                future = executor.submit(fn, *args)
+            except BrokenProcessPool:
+                future = None
+            else:
+                self._pending += 1
+                metrics.gauge("bcrypt.pending", self._pending)
+
+        if future is None:
+            self._drop_broken(executor)
+
+            if not retry:
+                raise HasherBusy()
+
+            return self._submit(fn, *args, retry=False)
+
+        future.add_done_callback(
+            lambda future: self._release(future, executor))
+        return future
+
+    def _release(self, future, executor):
+        """A pooled hash is done: one fewer pending. If it failed because
+        the pool broke, drop the pool so the next hash starts a new one.
+        """
+
+        with self._lock:
+            self._pending = max(self._pending - 1, 0)
+            metrics.gauge("bcrypt.pending", self._pending)
+
+        if (not future.cancelled()
+                and isinstance(future.exception(), BrokenProcessPool)):
+            self._drop_broken(executor)
+
+    def _drop_broken(self, executor):
+        """Forget this broken pool, if it's still ours, so the next hash
+        starts a new one.
+        """
+
+        with self._lock:
+            if self._executor is not executor:
+                return
+
+            self._executor = None
+
+        metrics.incr("bcrypt.pool_broken")
+        logger.error("password hashing pool broke; starting a new one")
+        executor.shutdown(wait=False)
+
+    def _background_done(self, key):
+        """A hash_in_background hash is done (or wasn't queued after all)."""
+
+        with self._lock:
+            self._background_pending = max(self._background_pending - 1, 0)
+            self._background_keys.discard(key)
+
+    def _get_background(self):
+        """Thread for background hashes when there's no pool."""
+
+        with self._lock:
+            if self._background is None:
+                self._background = ThreadPoolExecutor(1, "bcrypt")
+
+            return self._background
+
+
+password_hasher = PasswordHasher()
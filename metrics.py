@@ -0,0 +1,82 @@
+"""In-process metrics for Flask Cafe."""
+
+import threading
+import time
+from contextlib import contextmanager
+
+
+class Metrics:
+    """Counters, gauges and timings, kept in memory for this process.
+
+        E.g.  metrics.incr("bcrypt.rejected")
+              metrics.gauge("bcrypt.pending", 3)
+              with metrics.timer("bcrypt.check"):
+                  ...
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Forget everything recorded so far."""
+
+        with self._lock:
+            self._counters = {}
+            self._gauges = {}
+            self._timings = {}
+
+    def incr(self, name, amount=1):
+        """Add amount to a counter."""
+
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + amount
+
+    def gauge(self, name, value):
+        """Set a gauge to its current value."""
+
+        with self._lock:
+            self._gauges[name] = value
+
+    def observe(self, name, seconds):
+        """Record one timing, in seconds."""
+
+        with self._lock:
+            timing = self._timings.setdefault(
+                name, {"count": 0, "total": 0.0, "max": 0.0})
+            timing["count"] += 1
+            timing["total"] += seconds
+            timing["max"] = max(timing["max"], seconds)
+
+    @contextmanager
+    def timer(self, name):
+        """Time the block and record it with observe()."""
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def snapshot(self):
+        """Return everything recorded, as a JSON-friendly dict:
+
+            {"counters": {name: n, ...},
+             "gauges": {name: value, ...},
+             "timings": {name: {"count", "total", "mean", "max"}, ...}}
+        """
+
+        with self._lock:
+            timings = {
+                name: {**t, "mean": t["total"] / t["count"]}
+                for name, t in self._timings.items()
+            }
+
+            return {
+                "counters": dict(self._counters),
+                "gauges": dict(self._gauges),
+                "timings": timings,
+            }
+
+
+metrics = Metrics()
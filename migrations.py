@@ -0,0 +1,231 @@
+"""Versioned schema migrations for Flask Cafe.
+
+Each migration is a function registered with @migration(version); they run
+in version order, and each one applied is recorded in schema_migrations,
+so running them again only applies what's new:
+
+    flask migrate            # apply pending migrations
+    flask migrate --status   # list migrations & whether they're applied
+
+A database with no tables yet is built from the models with create_all()
+and every migration is recorded as applied, as the models already include
+them.
+
+Migrations normally run in a transaction. Ones registered with
+transactional=False (needed for CREATE INDEX CONCURRENTLY, which doesn't
+block writes while it builds) run in autocommit mode instead, so must be
+safe to re-run after failing partway through.
+"""
+
+from collections import namedtuple
+
+from sqlalchemy import inspect, text
+
+from models import db
+
+# arbitrary key for pg_advisory_lock: one migration runner at a time
+MIGRATION_LOCK_KEY = 727_001
+
+Migration = namedtuple("Migration", "version name fn transactional")
+
+MIGRATIONS = []
+
+
+def migration(version, transactional=True):
+    """Register the decorated function(conn) as migration number version."""
+
+    def register(fn):
+        MIGRATIONS.append(Migration(version, fn.__name__, fn, transactional))
+        MIGRATIONS.sort(key=lambda m: m.version)
+        return fn
+
+    return register
+
+
+def create_index_concurrently(conn, name, table, columns):
+    """Create index, if not there already, without blocking writes.
+
+    A failed CREATE INDEX CONCURRENTLY leaves an invalid index behind;
+    that's dropped and built again.
+    """
+
+    valid = conn.scalar(
+        text("SELECT indisvalid FROM pg_index "
+             "WHERE indexrelid = to_regclass(:name)"),
+        {"name": name})
+
+    if valid:
+        return
+
+    if valid is not None:
+        conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {name}"))
+
+    conn.execute(text(
+        f"CREATE INDEX CONCURRENTLY {name} ON {table} ({', '.join(columns)})"))
+
+
+#######################################
+# migrations
+
+
+@migration(1)
+def add_cafes_like_count(conn):
+    conn.execute(text(
+        "ALTER TABLE cafes "
+        "ADD COLUMN IF NOT EXISTS like_count INTEGER NOT NULL DEFAULT 0"))
+    conn.execute(text("""
+        UPDATE cafes SET like_count = counts.n
+        FROM (SELECT liked_cafes, COUNT(*) AS n
+              FROM cafes_users GROUP BY liked_cafes) AS counts
+        WHERE cafes.id = counts.liked_cafes"""))
+
+
+@migration(2, transactional=False)
+def add_cafe_sort_indexes(conn):
+    create_index_concurrently(conn, "ix_cafes_name_id", "cafes",
+                              ["name", "id"])
+    create_index_concurrently(conn, "ix_cafes_like_count_id", "cafes",
+                              ["like_count", "id"])
+
+
+@migration(3, transactional=False)
+def add_foreign_key_indexes(conn):
+    create_index_concurrently(conn, "ix_cafes_city_code", "cafes",
+                              ["city_code"])
+    create_index_concurrently(conn, "ix_specialties_cafe_id", "specialties",
+                              ["cafe_id"])
+    create_index_concurrently(conn, "ix_cafes_users_liking_users",
+                              "cafes_users", ["liking_users"])
+
+
+@migration(4)
+def add_specialties_type_rank(conn):
+    conn.execute(text("""
+        ALTER TABLE specialties
+        ADD COLUMN IF NOT EXISTS type_rank SMALLINT GENERATED ALWAYS AS (
+            CASE type WHEN 'beverage' THEN 0 WHEN 'dessert' THEN 1
+                      WHEN 'course' THEN 2 WHEN 'side' THEN 3 END) STORED"""))
+
+
+@migration(5, transactional=False)
+def add_specialties_type_rank_index(conn):
+    create_index_concurrently(conn, "ix_specialties_cafe_id_type_rank_name",
+                              "specialties", ["cafe_id", "type_rank", "name"])
+    # the new index starts with cafe_id, so covers this one's lookups
+    conn.execute(text("DROP INDEX CONCURRENTLY IF EXISTS "
+                      "ix_specialties_cafe_id"))
+
+
+@migration(6)
+def add_cafes_version(conn):
+    conn.execute(text(
+        "ALTER TABLE cafes "
+        "ADD COLUMN IF NOT EXISTS version INTEGER NOT NULL DEFAULT 1"))
+
+
+@migration(7)
+def add_updated_at(conn):
+    for table in ["cities", "cafes", "specialties"]:
+        conn.execute(text(
+            f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS "
+            f"updated_at TIMESTAMPTZ NOT NULL DEFAULT now()"))
+
+
+@migration(8)
+def add_city_and_specialty_versions(conn):
+    for table in ["cities", "specialties"]:
+        conn.execute(text(
+            f"ALTER TABLE {table} "
+            f"ADD COLUMN IF NOT EXISTS version INTEGER NOT NULL DEFAULT 1"))
+
+
+@migration(9)
+def add_catalog_versions(conn):
+    conn.execute(text("""
+        CREATE TABLE IF NOT EXISTS catalog_versions (
+            name VARCHAR(20) PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 1)"""))
+
+
+#######################################
+# runner
+
+
+def get_applied(conn):
+    """Return set of versions applied to this database."""
+
+    conn.execute(text("""
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            applied_at TIMESTAMPTZ NOT NULL DEFAULT now())"""))
+
+    return set(conn.scalars(text("SELECT version FROM schema_migrations")))
+
+
+def record(conn, m):
+    """Record migration m as applied."""
+
+    conn.execute(
+        text("INSERT INTO schema_migrations (version, name) "
+             "VALUES (:version, :name) ON CONFLICT DO NOTHING"),
+        {"version": m.version, "name": m.name})
+
+
+def migrate(engine=None):
+    """Apply pending migrations; return list of names of those applied."""
+
+    engine = engine or db.engine
+    applied = []
+
+    with engine.connect() as lock_conn:
+        lock_conn = lock_conn.execution_options(isolation_level="AUTOCOMMIT")
+        lock_conn.execute(text("SELECT pg_advisory_lock(:key)"),
+                          {"key": MIGRATION_LOCK_KEY})
+
+        try:
+            with engine.begin() as conn:
+                done = get_applied(conn)
+
+                if not inspect(conn).has_table("cafes"):
+                    # a new database: the models are the latest schema
+                    db.metadata.create_all(conn)
+
+                    for m in MIGRATIONS:
+                        record(conn, m)
+
+                    return []
+
+            for m in MIGRATIONS:
+                if m.version in done:
+                    continue
+
+                if m.transactional:
+                    with engine.begin() as conn:
+                        m.fn(conn)
+                        record(conn, m)
+                else:
+                    with engine.connect() as conn:
+                        conn = conn.execution_options(
+                            isolation_level="AUTOCOMMIT")
+                        m.fn(conn)
+                        record(conn, m)
+
+                applied.append(m.name)
+
+        finally:
+            lock_conn.execute(text("SELECT pg_advisory_unlock(:key)"),
+                              {"key": MIGRATION_LOCK_KEY})
+
+    return applied
+
+
+def status(engine=None):
+    """Return list of (version, name, applied?) for every migration."""
+
+    engine = engine or db.engine
+
+    with engine.begin() as conn:
+        done = get_applied(conn)
+
+    return [(m.version, m.name, m.version in done) for m in MIGRATIONS]
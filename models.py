@@ -1,17 +1,53 @@
 """Data models for Flask Cafe"""
 
 
-from flask_bcrypt import Bcrypt
+from types import MappingProxyType
+
 from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy.session import Session as FlaskSession
+from sqlalchemy import event
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.orm import Session, make_transient_to_detached, object_session
+from sqlalchemy.sql.dml import UpdateBase
+from cache import page_cache
+from hashing import password_hasher
 from mapping import get_map_url
+from pagination import keyset_page
+
+REPLICA_BIND = "replica"
+
+
+class RoutingSession(FlaskSession):
+    """Session that can send reads to a read replica.
+
+    While info["use_replica"] is set, reads go to the REPLICA_BIND engine
+    (if SQLALCHEMY_BINDS has one). Writes always go to the primary, and the
+    first one turns use_replica off, so the rest of the session reads its
+    own writes. info["wrote"] records that there was a write.
+    """
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None:
+            if self._flushing or isinstance(clause, UpdateBase):
+                self.info["wrote"] = True
+                self.info["use_replica"] = False
 
-bcrypt = Bcrypt()
-db = SQLAlchemy()
+            elif self.info.get("use_replica"):
+                replica = self._db.engines.get(REPLICA_BIND)
+
+                if replica is not None:
+                    return replica
+
+        return super().get_bind(mapper, clause, bind, **kwargs)
+
+
+db = SQLAlchemy(session_options={"class_": RoutingSession})
 
 DEFAULT_CAFE_IMAGE_URL = "/static/images/default-cafe.jpg"
 DEFAULT_USER_IMAGE_URL = "/static/images/default-pic.png"
 DEFAULT_SPECIALTY_IMAGE_URL = None
-BCRYPT_WORK_FACTOR = 9
+# specialty types, in the order they're listed on a cafe's page
+SPECIALTY_TYPES = ('beverage', 'dessert', 'course', 'side')
 
 
 class City(db.Model):
@@ -34,13 +70,104 @@ class City(db.Model):
         nullable=False,
     )
 
+    # bumped by every update (see _bump_version), so sums of versions
+    # change with every commit that changes rows (see queries.py validators)
+    version = db.Column(
+        db.Integer,
+        nullable=False,
+        default=1,
+        server_default='1',
+    )
+
+    # when the row last changed
+    updated_at = db.Column(
+        db.DateTime(timezone=True),
+        nullable=False,
+        default=db.func.now(),
+        onupdate=db.func.now(),
+        server_default=db.func.now(),
+    )
+
     @classmethod
     def get_choices_cities(cls):
         """Create a list of city choices, with each choice as a
         (code, label) tuple.
             E.g. [('berk', 'Berkley'), ('oak', 'Oakland'), ...]
         """
-        return [(c.code, c.name) for c in cls.query.order_by('name')]
+        return city_registry.choices()
+
+
+class CityRegistry:
+    """In-process, read-only map of every city: code -> (name, state).
+
+    The cities table is tiny and rarely changes, so it's read once (on first
+    use) and kept in memory; it's reloaded after any commit that changes a
+    city (see the session events below), and by sync when another process
+    has changed one.
+    """
+
+    def __init__(self):
+        self._cities = None
+        # the "cities" CatalogVersion the cities were loaded at
+        self.version = None
+
+    def load(self):
+        """(Re)load all cities from the database; return the new mapping."""
+
+        # use a connection of our own: this runs from after_commit, when the
+        # session itself can't emit SQL
+        with db.engine.connect() as conn:
+            # read first, so a change committed meanwhile is seen as newer
+            version = conn.scalar(
+                db.select(CatalogVersion.version)
+                .where(CatalogVersion.name == "cities"))
+            rows = conn.execute(
+                db.select(City.code, City.name, City.state)
+                .order_by(City.name))
+
+            cities = {code: (name, state) for code, name, state in rows}
+
+        self._cities = MappingProxyType(cities)
+        self.version = version
+        return self._cities
+
+    def sync(self, version):
+        """Reload if version (of the "cities" CatalogVersion, e.g. from a
+        validator) is newer than the one the cities were loaded at.
+
+        Versions from a lagging replica may be older; they're ignored.
+        """
+
+        if self._cities is None or (
+                version is not None
+                and (self.version is None or version > self.version)):
+            self.load()
+
+    @property
+    def cities(self):
+        """Mapping of code -> (name, state), sorted by city name."""
+
+        return self._cities if self._cities is not None else self.load()
+
+    def get(self, code):
+        """Return (name, state) for city code.
+
+        Reloads once if the code isn't known yet (e.g. a city added by
+        another process). Raises KeyError if there's no such city.
+        """
+
+        try:
+            return self.cities[code]
+        except KeyError:
+            return self.load()[code]
+
+    def choices(self):
+        """Return list of (code, name) choices, sorted by name."""
+
+        return [(code, name) for code, (name, state) in self.cities.items()]
+
+
+city_registry = CityRegistry()
 
 
 class Cafe(db.Model):
@@ -50,6 +177,11 @@ class Cafe(db.Model):
 
     __table_args__ = (
        db.UniqueConstraint('name', 'address', 'city_code'),
+       # support the keyset-paginated sorts of the cafe list
+       db.Index('ix_cafes_name_id', 'name', 'id'),
+       db.Index('ix_cafes_like_count_id', 'like_count', 'id'),
+       # cafes in a city
+       db.Index('ix_cafes_city_code', 'city_code'),
     )
 
     id = db.Column(
@@ -91,8 +223,41 @@ class Cafe(db.Model):
         default=DEFAULT_CAFE_IMAGE_URL,
     )
 
+    # number of users who like this cafe; kept up to date by Like.add and
+    # Like.remove (fix drift with Cafe.reconcile_like_counts)
+    like_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    # bumped whenever the cafe is edited (see _bump_version), so its cached
+    # list card, which is keyed by it, is rendered again
+    version = db.Column(
+        db.Integer,
+        nullable=False,
+        default=1,
+        server_default='1',
+    )
+
+    # when the row last changed
+    updated_at = db.Column(
+        db.DateTime(timezone=True),
+        nullable=False,
+        default=db.func.now(),
+        onupdate=db.func.now(),
+        server_default=db.func.now(),
+    )
+
     city = db.relationship("City", backref='cafes')
-    specialties = db.relationship("Specialty", backref='cafe')
+    # sorted by type (in SPECIALTY_TYPES order) & name, which is the order
+    # of the (cafe_id, type_rank, name) index
+    specialties = db.relationship(
+        "Specialty",
+        backref='cafe',
+        order_by=lambda: (Specialty.type_rank, Specialty.name),
+    )
     # Backref in User
     # liking_users = db.relationship(
     #    'User', secondary='cafes_users', backref='liked_cafes')
@@ -100,16 +265,84 @@ class Cafe(db.Model):
     def __repr__(self):
         return f'<Cafe id={self.id} name="{self.name}">'
 
+    @classmethod
+    def get_page(cls, after=None, limit=20, options=(), sort="name"):
+        """Return (cafes, next_cursor) for one page of cafes.
+
+        sort is a key of CAFE_SORTS: "name" (A-Z) or "popular" (most liked
+        first). Pass next_cursor back in as `after` to get the following
+        page; it is None on the last page. Raises InvalidCursor on a bad
+        cursor. options are loader options applied to the cafes query.
+        """
+
+        columns, descending = CAFE_SORTS[sort]
+        query = cls.query.options(*options)
+
+        return keyset_page(query, columns, after, limit, descending)
+
+    @classmethod
+    def reconcile_like_counts(cls):
+        """Recount every cafe's likes from cafes_users in one bulk UPDATE,
+        fixing any like_count that has drifted.
+
+        Returns number of cafes whose like_count was fixed.
+        """
+
+        counts = (db.select(cls.id, db.func.count(Like.liked_cafes).label("n"))
+                  .outerjoin(Like, Like.liked_cafes == cls.id)
+                  .group_by(cls.id)
+                  .subquery())
+
+        result = db.session.execute(
+            db.update(cls)
+            .where(cls.id == counts.c.id, cls.like_count != counts.c.n)
+            .values(like_count=counts.c.n),
+            execution_options={"synchronize_session": False,
+                               "cache_tags": ("like-counts",)})
+
+        return result.rowcount
+
+    @classmethod
+    def change_like_count(cls, cafe_id, delta):
+        """Add delta to this cafe's like_count, in the current transaction."""
+
+        db.session.execute(
+            db.update(cls)
+            .where(cls.id == cafe_id)
+            .values(like_count=cls.like_count + delta),
+            execution_options={"cache_tags": ("like-counts",)})
+
+    def serialize(self):
+        """Serialize to dictionary."""
+
+        return {
+            "id": self.id,
+            "name": self.name,
+            "description": self.description,
+            "url": self.url,
+            "address": self.address,
+            "city_code": self.city_code,
+            "image_url": self.image_url,
+            "like_count": self.like_count,
+        }
+
     def get_city_state(self):
         """Return 'city, state' for cafe."""
 
-        city = self.city
-        return f'{city.name}, {city.state}'
+        name, state = city_registry.get(self.city_code)
+        return f'{name}, {state}'
 
     def get_map_url(self):
         """Return map url from Google Maps API for cafe."""
-        city = self.city
-        return get_map_url(self.address, city.name, city.state)
+        name, state = city_registry.get(self.city_code)
+        return get_map_url(self.address, name, state)
+
+
+# sorts for Cafe.get_page: sort name -> (sort key columns, descending?)
+CAFE_SORTS = {
+    "name": ((Cafe.name, Cafe.id), False),
+    "popular": ((Cafe.like_count, Cafe.id), True),
+}
 
 
 class Specialty(db.Model):
@@ -119,6 +352,9 @@ class Specialty(db.Model):
 
     __table_args__ = (
        db.UniqueConstraint('name', 'cafe_id'),
+       # a cafe's specialties, already in Cafe.specialties order
+       db.Index('ix_specialties_cafe_id_type_rank_name',
+                'cafe_id', 'type_rank', 'name'),
     )
 
     id = db.Column(
@@ -143,6 +379,17 @@ class Specialty(db.Model):
         nullable=False,
     )
 
+    # position of type in SPECIALTY_TYPES, kept up to date by the database
+    type_rank = db.Column(
+        db.SmallInteger,
+        db.Computed(
+            "CASE type "
+            + " ".join(f"WHEN '{type}' THEN {rank}"
+                       for rank, type in enumerate(SPECIALTY_TYPES))
+            + " END",
+            persisted=True),
+    )
+
     description = db.Column(
         db.Text,
         nullable=False,
@@ -155,10 +402,42 @@ class Specialty(db.Model):
         default='',
     )
 
+    # bumped by every update, like City.version
+    version = db.Column(
+        db.Integer,
+        nullable=False,
+        default=1,
+        server_default='1',
+    )
+
+    # when the row last changed
+    updated_at = db.Column(
+        db.DateTime(timezone=True),
+        nullable=False,
+        default=db.func.now(),
+        onupdate=db.func.now(),
+        server_default=db.func.now(),
+    )
+
     # Backref in Cafe
     # cafe = db.relationship("Cafe", backref='specialties')
 
 
+def _bump_version(mapper, connection, target):
+    """Bump version of a city, cafe or specialty being updated (in SQL, so
+    concurrent updates each count). Bulk like count updates don't go through
+    here: like counts are only shown on cards sorted by them, which are
+    keyed by them (see app.render_cafe_cards).
+    """
+
+    if object_session(target).is_modified(target, include_collections=False):
+        target.version = type(target).version + 1
+
+
+for model in (City, Cafe, Specialty):
+    event.listen(model, "before_update", _bump_version)
+
+
 class User(db.Model):
     """User information."""
 
@@ -219,16 +498,63 @@ class User(db.Model):
     def get_full_name(self):
         return f"{self.first_name} {self.last_name}"
 
+    def to_cache(self):
+        """Return this user's column values, as a dict safe to cache
+        outside of any database session.
+        """
+
+        return {c.key: getattr(self, c.key) for c in self.__table__.columns}
+
+    @classmethod
+    def from_cache(cls, values):
+        """Return user rebuilt from to_cache() values, attached to the
+        current session without querying the database.
+        """
+
+        user = cls(**values)
+        make_transient_to_detached(user)
+
+        return db.session.merge(user, load=False)
+
+    def likes_cafe(self, cafe_id):
+        """Does this user like the cafe with this id?"""
+
+        return Like.exists(self.id, cafe_id)
+
+    def likes_cafes(self, cafe_ids):
+        """Return {cafe_id: True|False} for whether this user likes each of
+        these cafes, from one query.
+        """
+
+        liked = Like.liked_among(self.id, cafe_ids)
+        return {cafe_id: cafe_id in liked for cafe_id in cafe_ids}
+
+    def get_liked_cafes(self, options=()):
+        """Return list of cafes this user likes, sorted by name.
+
+        options are loader options applied to the cafes query.
+        """
+
+        return (Cafe
+                .query
+                .options(*options)
+                .join(Like, Like.liked_cafes == Cafe.id)
+                .filter(Like.liking_users == self.id)
+                .order_by(Cafe.name)
+                .all())
+
     @classmethod
     def register(cls, **data):
-        """Register user with hashed password and return user."""
+        """Register user with hashed password and return user.
+
+        Raises HasherBusy if too many passwords are being hashed already.
+        """
         print('data: ', data)
 
         if len(data['password']) < 6:
             raise ValueError("Too short password")
 
-        hashed = bcrypt.generate_password_hash(
-            data['password'], BCRYPT_WORK_FACTOR).decode('utf8')
+        hashed = password_hasher.hash(data['password'])
 
         user = cls(username=data['username'],
                    hashed_password=hashed,
@@ -253,15 +579,49 @@ class User(db.Model):
         """Validate that user exists & password is correct.
 
         Return user if valid; else return False.
+        Raises HasherBusy if too many passwords are being hashed already.
+
+        If the stored hash was made with an old work factor, it's redone
+        with the configured one in the background (see upgrade_password).
         """
 
         u = cls.query.filter_by(username=username).one_or_none()
 
-        if u and bcrypt.check_password_hash(u.hashed_password, pwd):
+        if u and password_hasher.check(u.hashed_password, pwd):
+            if password_hasher.needs_rehash(u.hashed_password):
+                u.upgrade_password(pwd)
             return u
         else:
             return False
 
+    def upgrade_password(self, pwd):
+        """Re-hash pwd (known correct) at the configured work factor, in the
+        background, and save it.
+
+        The save only happens if the stored hash hasn't changed meanwhile
+        (e.g. a password change), and uses its own connection, not the
+        request's session. Returns a Future for whether it was saved, or
+        None if the hasher is too busy or already upgrading this user's
+        password; it'll be tried on the next login.
+        """
+
+        engine = db.engine
+        user_id = self.id
+        old_hash = self.hashed_password
+
+        def save(new_hash):
+            with engine.begin() as conn:
+                result = conn.execute(
+                    db.update(User)
+                    .where(User.id == user_id,
+                           User.hashed_password == old_hash)
+                    .values(hashed_password=new_hash))
+
+            return result.rowcount == 1
+
+        return password_hasher.hash_in_background(
+            pwd, save, key=f"user:{user_id}")
+
 
 class Like(db.Model):
     """Cafes liked by users."""
@@ -278,8 +638,274 @@ class Like(db.Model):
         db.Integer,
         db.ForeignKey('users.id'),
         primary_key=True,
+        # the primary key starts with liked_cafes, so can't find a user's likes
+        index=True,
+    )
+
+    @classmethod
+    def exists(cls, user_id, cafe_id):
+        """Return True if this user likes this cafe, else False.
+
+        A single primary key lookup on cafes_users, so it costs the same no
+        matter how many cafes the user likes.
+        """
+
+        return db.session.scalar(
+            db.select(
+                db.exists().where(cls.liking_users == user_id,
+                                  cls.liked_cafes == cafe_id)))
+
+    @classmethod
+    def add(cls, user_id, cafe_id):
+        """Make this user like this cafe, if they don't already.
+
+        Returns True if a like was added, False if it already existed.
+        Raises IntegrityError if there's no such user or cafe.
+
+        A single INSERT ... ON CONFLICT DO NOTHING: the user's liked cafes
+        aren't loaded, and the foreign keys check the cafe exists.
+        """
+
+        result = db.session.execute(
+            pg_insert(cls)
+            .values(liked_cafes=cafe_id, liking_users=user_id)
+            .on_conflict_do_nothing()
+            .returning(cls.liked_cafes))
+
+        added = result.first() is not None
+
+        if added:
+            Cafe.change_like_count(cafe_id, 1)
+
+        return added
+
+    @classmethod
+    def remove(cls, user_id, cafe_id):
+        """Make this user not like this cafe, if they do.
+
+        Returns True if a like was removed, False if there wasn't one.
+        """
+
+        result = db.session.execute(
+            db.delete(cls)
+            .where(cls.liking_users == user_id, cls.liked_cafes == cafe_id)
+            .returning(cls.liked_cafes))
+
+        removed = result.first() is not None
+
+        if removed:
+            Cafe.change_like_count(cafe_id, -1)
+
+        return removed
+
+    @classmethod
+    def count_for(cls, cafe_id):
+        """Return number of users who like this cafe (None if there's no
+        such cafe).
+        """
+
+        return db.session.scalar(
+            db.select(Cafe.like_count).where(Cafe.id == cafe_id))
+
+    @classmethod
+    def liked_among(cls, user_id, cafe_ids):
+        """Return set of the ids in cafe_ids that this user likes.
+
+        One `IN` lookup on cafes_users, however many ids are given.
+        """
+
+        if not cafe_ids:
+            return set()
+
+        return set(db.session.scalars(
+            db.select(cls.liked_cafes).where(
+                cls.liking_users == user_id,
+                cls.liked_cafes.in_(cafe_ids))))
+
+
+class CatalogVersion(db.Model):
+    """Version of something many pages show (e.g. the "cafe-list"), bumped
+    in the same transaction as any change to it, so validators can read it
+    in one primary key lookup instead of scanning the table.
+
+    Names are page_cache tags in VERSIONED_TAGS: changes invalidating one
+    bump its version too (see the session events below). "cities" also
+    tells processes when to reload their city_registry.
+    """
+
+    __tablename__ = 'catalog_versions'
+
+    name = db.Column(
+        db.String(20),
+        primary_key=True,
     )
 
+    version = db.Column(
+        db.Integer,
+        nullable=False,
+        default=1,
+        server_default='1',
+    )
+
+    @classmethod
+    def bump(cls, session, names):
+        """Bump the versions with these names (adding any missing ones), in
+        session's current transaction.
+        """
+
+        session.execute(
+            pg_insert(cls)
+            .values([{"name": name} for name in sorted(names)])
+            .on_conflict_do_update(index_elements=[cls.name],
+                                   set_={"version": cls.version + 1}))
+
+    @classmethod
+    def get_many(cls, names):
+        """Return tuple of the versions with these names (None for any
+        never bumped), in one query.
+        """
+
+        found = dict(db.session.execute(
+            db.select(cls.name, cls.version).where(cls.name.in_(names))).all())
+
+        return tuple(found.get(name) for name in names)
+
+
+# page_cache tags with a CatalogVersion: the cafe list (cafes & cities),
+# cities (on every card) and like counts, so validators needn't scan cafes
+VERSIONED_TAGS = frozenset({"cafe-list", "cities", "like-counts"})
+
+
+#######################################
+# keep the city registry in sync with the cities table
+
+
+@event.listens_for(Session, "after_flush")
+def _track_city_changes(session, flush_context):
+    """Note when a flush adds, changes or deletes a city."""
+
+    changed = session.new | session.dirty | session.deleted
+
+    if any(isinstance(obj, City) for obj in changed):
+        session.info["cities_changed"] = True
+
+
+@event.listens_for(Session, "do_orm_execute")
+def _track_city_bulk_changes(orm_execute_state):
+    """Note bulk updates/deletes of cities, e.g. City.query.delete()."""
+
+    mapper = orm_execute_state.bind_mapper
+
+    if ((orm_execute_state.is_update or orm_execute_state.is_delete)
+            and mapper is not None and mapper.class_ is City):
+        orm_execute_state.session.info["cities_changed"] = True
+
+
+@event.listens_for(Session, "after_commit")
+def _refresh_city_registry(session):
+    """Reload the city registry once city changes are committed."""
+
+    if session.info.pop("cities_changed", False):
+        city_registry.load()
+
+
+@event.listens_for(Session, "after_rollback")
+def _forget_city_changes(session):
+    """Rolled-back city changes don't need a reload."""
+
+    session.info.pop("cities_changed", None)
+
+
+#######################################
+# invalidate page_cache entries about what's changed
+
+
+def get_cache_tags(obj):
+    """Return page_cache tags for entries showing this cafe, specialty or
+    city (none for other objects).
+    """
+
+    if isinstance(obj, Cafe):
+        return {f"cafe:{obj.id}", "cafe-list"}
+
+    if isinstance(obj, Specialty):
+        return {f"cafe:{obj.cafe_id}"}
+
+    if isinstance(obj, City):
+        # the cafe list shows city names, too, on every card
+        return {f"city:{obj.code}", "cafe-list", "cities"}
+
+    return set()
+
+
+@event.listens_for(Session, "after_flush")
+def _track_cache_changes(session, flush_context):
+    """Note tags of cafes, specialties & cities a flush changes, and bump
+    the catalog versions of those in VERSIONED_TAGS.
+    """
+
+    tags = set()
+
+    for obj in session.new | session.dirty | session.deleted:
+        tags |= get_cache_tags(obj)
+
+    if tags:
+        session.info.setdefault("cache_tags", set()).update(tags)
+
+    if tags & VERSIONED_TAGS:
+        CatalogVersion.bump(session, tags & VERSIONED_TAGS)
+
+
+@event.listens_for(Session, "do_orm_execute")
+def _track_cache_bulk_changes(orm_execute_state):
+    """Note bulk updates/deletes of cafes, specialties & cities.
+
+    A statement can say which tags it affects with the "cache_tags"
+    execution option (as Cafe.change_like_count does); otherwise, as we
+    can't tell which rows it touched, the whole cache is cleared (and the
+    cafe list's & cities' catalog versions bumped).
+    """
+
+    mapper = orm_execute_state.bind_mapper
+
+    if not ((orm_execute_state.is_update or orm_execute_state.is_delete)
+            and mapper is not None
+            and mapper.class_ in (Cafe, Specialty, City)):
+        return
+
+    info = orm_execute_state.session.info
+    tags = orm_execute_state.execution_options.get("cache_tags")
+
+    if tags is None:
+        info["cache_clear"] = True
+        tags = {"cafe-list", "cities"}
+    else:
+        info.setdefault("cache_tags", set()).update(tags)
+
+    if VERSIONED_TAGS.intersection(tags):
+        CatalogVersion.bump(orm_execute_state.session,
+                            VERSIONED_TAGS.intersection(tags))
+
+
+@event.listens_for(Session, "after_commit")
+def _invalidate_cache(session):
+    """Invalidate cache entries once changes to them are committed."""
+
+    tags = session.info.pop("cache_tags", set())
+
+    if session.info.pop("cache_clear", False):
+        page_cache.clear()
+    elif tags:
+        page_cache.invalidate(*sorted(tags))
+
+
+@event.listens_for(Session, "after_rollback")
+def _forget_cache_changes(session):
+    """Rolled-back changes don't need invalidating."""
+
+    session.info.pop("cache_tags", None)
+    session.info.pop("cache_clear", None)
+
 
 def connect_db(app):
     """Connect this database to provided Flask app.
@@ -287,6 +913,4 @@ def connect_db(app):
     You should call this in your Flask app.
     """
 
-    app.app_context().push()
-    db.app = app
     db.init_app(app)
@@ -0,0 +1,80 @@
+"""Keyset (seek) pagination helpers for Flask Cafe."""
+
+# Keyset pagination filters on the sort key of the last row of the previous
+# page instead of using OFFSET, so every page costs one index range scan no
+# matter how deep it is:
+# https://use-the-index-luke.com/no-offset
+
+import base64
+import binascii
+import json
+
+from sqlalchemy import tuple_
+
+
+class InvalidCursor(ValueError):
+    """Raised when a pagination cursor can't be decoded."""
+
+
+def encode_cursor(*values):
+    """Encode sort key values into an opaque, URL-safe cursor string.
+
+        E.g. encode_cursor("Perch Coffee", 2) -> 'WyJQZXJjaCBDb2ZmZWUiLCAyXQ'
+    """
+
+    raw = json.dumps(values).encode('utf8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor, types):
+    """Decode a cursor made by encode_cursor into a tuple of values, one of
+    each of these types.
+
+        E.g. decode_cursor('WyJQZXJjaCBDb2ZmZWUiLCAyXQ', (str, int))
+            -> ('Perch Coffee', 2)
+
+    Raises InvalidCursor if the cursor is malformed, or has a string the
+    database can't take (one with a NUL character).
+    """
+
+    padded = cursor + '=' * (-len(cursor) % 4)
+
+    try:
+        values = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+    except (binascii.Error, UnicodeError, ValueError):
+        raise InvalidCursor(cursor)
+
+    if (not isinstance(values, list)
+            or len(values) != len(types)
+            or not all(isinstance(v, t) for v, t in zip(values, types))
+            or any(isinstance(v, str) and "\x00" in v for v in values)):
+        raise InvalidCursor(cursor)
+
+    return tuple(values)
+
+
+def keyset_page(query, columns, after=None, limit=20, descending=False):
+    """Return (items, next_cursor) for one page of query, sorted by columns.
+
+    columns should end in a unique column (like a primary key) so the sort
+    key of every row is distinct. `after` is a cursor from a previous call;
+    next_cursor is None on the last page.
+    """
+
+    key = tuple_(*columns)
+
+    if after:
+        values = decode_cursor(after, [c.type.python_type for c in columns])
+        query = query.filter(key < values if descending else key > values)
+
+    order = [c.desc() for c in columns] if descending else columns
+    items = query.order_by(*order).limit(limit + 1).all()
+
+    if len(items) <= limit:
+        return items, None
+
+    items = items[:limit]
+    last = items[-1]
+    next_cursor = encode_cursor(*[getattr(last, c.key) for c in columns])
+
+    return items, next_cursor
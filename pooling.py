@@ -0,0 +1,143 @@
+"""Database connection pooling for Flask Cafe, with metrics.
+
+A slow request can be waiting for a free connection (the pool is
+saturated) or waiting on the database (a slow query). These pools record
+enough to tell which:
+
+    db.pool.<bind>.wait        timing: how long getting a connection took
+    db.pool.<bind>.checked_out gauge: connections in use right now
+    db.pool.<bind>.overflow    counter: connections opened beyond pool_size
+    db.pool.<bind>.timeout     counter: gave up waiting for a connection
+    db.query.<bind>            timing: how long each SQL statement took
+
+where bind is the pool's name (pool_logging_name; see bind_engine_options),
+e.g. "default" or "replica", so each database's pool is seen on its own.
+"""
+
+import threading
+import time
+
+from sqlalchemy import event, exc
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import NullPool, QueuePool
+
+from metrics import metrics
+
+
+def get_pool_name(pool):
+    """Return name for this pool in metrics: its logging name, or
+    "default".
+    """
+
+    return pool.logging_name or "default"
+
+
+class InstrumentedPool:
+    """Mixin for SQLAlchemy pools: records wait time & occupancy."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._in_use = 0
+        self._in_use_lock = threading.Lock()
+        self.metrics_prefix = f"db.pool.{get_pool_name(self)}"
+
+    def _do_get(self):
+        start = time.perf_counter()
+
+        try:
+            record = super()._do_get()
+        except exc.TimeoutError:
+            metrics.incr(f"{self.metrics_prefix}.timeout")
+            raise
+        finally:
+            metrics.observe(f"{self.metrics_prefix}.wait",
+                            time.perf_counter() - start)
+
+        self._count_in_use(1)
+        return record
+
+    def _do_return_conn(self, record):
+        self._count_in_use(-1)
+        super()._do_return_conn(record)
+
+    def _count_in_use(self, change):
+        with self._in_use_lock:
+            self._in_use += change
+            metrics.gauge(f"{self.metrics_prefix}.checked_out", self._in_use)
+
+
+class InstrumentedQueuePool(InstrumentedPool, QueuePool):
+    """QueuePool (SQLAlchemy's default) with metrics."""
+
+    def _inc_overflow(self):
+        opened = super()._inc_overflow()
+
+        # _overflow counts up from -pool_size; past 0 is beyond pool_size
+        if opened and self._overflow > 0:
+            metrics.incr(f"{self.metrics_prefix}.overflow")
+
+        return opened
+
+
+class InstrumentedNullPool(InstrumentedPool, NullPool):
+    """NullPool (a new connection every checkout) with metrics."""
+
+
+def engine_options(pool_size=5, max_overflow=10, pool_timeout=30,
+                   pool_recycle=-1, pre_ping=False, pgbouncer=False):
+    """Return SQLALCHEMY_ENGINE_OPTIONS for an instrumented pool.
+
+    The defaults are SQLAlchemy's own. With pgbouncer, connections aren't
+    pooled here at all (PgBouncer does that), so it's safe with PgBouncer in
+    transaction pooling mode: no connection, and so no session state, is
+    held between transactions. (psycopg2 doesn't use server-side prepared
+    statements, which transaction pooling would also break.)
+    """
+
+    if pgbouncer:
+        return {"poolclass": InstrumentedNullPool}
+
+    return {
+        "poolclass": InstrumentedQueuePool,
+        "pool_size": pool_size,
+        "max_overflow": max_overflow,
+        "pool_timeout": pool_timeout,
+        "pool_recycle": pool_recycle,
+        "pool_pre_ping": pre_ping,
+    }
+
+
+def bind_engine_options(engine_options, binds):
+    """Return (SQLALCHEMY_ENGINE_OPTIONS, SQLALCHEMY_BINDS) with each
+    engine's pool named after its bind key ("default" for the main one), for
+    metrics.
+
+    Flask-SQLAlchemy doesn't apply SQLALCHEMY_ENGINE_OPTIONS to binds, so
+    each bind gets them here too (a bind's own options win).
+    """
+
+    named_binds = {}
+
+    for key, value in binds.items():
+        if not isinstance(value, dict):
+            value = {"url": value}
+        named_binds[key] = {**engine_options, "pool_logging_name": key,
+                            **value}
+
+    return {**engine_options, "pool_logging_name": "default"}, named_binds
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _start_query_timer(conn, cursor, statement, parameters, context,
+                       executemany):
+    conn.info["query_start"] = time.perf_counter()
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _stop_query_timer(conn, cursor, statement, parameters, context,
+                      executemany):
+    start = conn.info.pop("query_start", None)
+
+    if start is not None:
+        metrics.observe(f"db.query.{get_pool_name(conn.engine.pool)}",
+                        time.perf_counter() - start)
@@ -0,0 +1,178 @@
+"""Query-shaping (eager loading) profiles, page loaders & validators for
+Flask Cafe views.
+"""
+
+from itertools import groupby
+from operator import attrgetter
+
+from sqlalchemy import func, literal, select
+from sqlalchemy.dialects.postgresql import aggregate_order_by
+from sqlalchemy.orm import load_only
+
+from models import db, CatalogVersion, Cafe, City, Specialty
+from mapping import get_map_url
+
+# Loader options for the cafes shown by each kind of page, so that a page
+# costs a constant number of queries instead of one lazy load per cafe:
+# https://docs.sqlalchemy.org/en/20/orm/queryguide/relationships.html
+#
+# "city, state" comes from the in-memory city_registry, so no profile needs
+# to load Cafe.city. (The cafe detail page uses get_cafe_snapshot instead.)
+LOADER_PROFILES = {
+    # cafe cards, which are mostly cached: what their cache keys & the page's
+    # cursor need (see app.render_cafe_cards)
+    "list": (
+        load_only(Cafe.id, Cafe.name, Cafe.version, Cafe.city_code,
+                  Cafe.like_count),
+    ),
+    # user's liked cafes on the profile page: just names and links
+    "profile": (
+        load_only(Cafe.id, Cafe.name),
+    ),
+}
+
+
+def loader_options(profile):
+    """Return the loader options for a profile in LOADER_PROFILES.
+
+        E.g. Cafe.query.options(*loader_options("list"))
+    """
+
+    return LOADER_PROFILES[profile]
+
+
+#######################################
+# cafe detail page
+
+
+class SpecialtySnapshot:
+    """A specialty, as shown on its cafe's detail page."""
+
+    def __init__(self, id, name, type, description, image_url):
+        self.id = id
+        self.name = name
+        self.type = type
+        self.description = description
+        self.image_url = image_url
+
+
+class CafeSnapshot:
+    """A cafe with what its detail page shows for everyone: city & ordered
+    specialties (whether the user likes it is up to the view). Plain
+    values, loaded all at once by get_cafe_snapshot; nothing more is loaded
+    on use.
+    """
+
+    def __init__(self, id, name, description, url, address, city_code,
+                 image_url, city_name, state, specialties):
+        self.id = id
+        self.name = name
+        self.description = description
+        self.url = url
+        self.address = address
+        self.city_code = city_code
+        self.image_url = image_url
+        self.city_name = city_name
+        self.state = state
+        self.specialties = specialties
+
+    def get_city_state(self):
+        """Return 'city, state' for cafe."""
+
+        return f'{self.city_name}, {self.state}'
+
+    def get_map_url(self):
+        """Return map url from Google Maps API for cafe."""
+
+        return get_map_url(self.address, self.city_name, self.state)
+
+    def get_specialties_by_type(self):
+        """Return list of (type, [specialties]), in specialties' order."""
+
+        return [(type, list(group))
+                for type, group in groupby(self.specialties,
+                                           key=attrgetter('type'))]
+
+
+def get_cafe_snapshot(cafe_id):
+    """Return CafeSnapshot for cafe with this id (or None if there's none):
+    one query in all.
+    """
+
+    specialties = (
+        select(func.coalesce(
+            func.json_agg(aggregate_order_by(
+                func.json_build_object(
+                    'id', Specialty.id,
+                    'name', Specialty.name,
+                    'type', Specialty.type,
+                    'description', Specialty.description,
+                    'image_url', Specialty.image_url),
+                Specialty.type_rank, Specialty.name)),
+            literal([], db.JSON)))
+        .where(Specialty.cafe_id == Cafe.id)
+        .scalar_subquery())
+
+    row = db.session.execute(
+        select(Cafe.id, Cafe.name, Cafe.description, Cafe.url,
+               Cafe.address, Cafe.city_code, Cafe.image_url,
+               City.name.label("city_name"), City.state,
+               specialties.label("specialties"))
+        .join(City, City.code == Cafe.city_code)
+        .where(Cafe.id == cafe_id)
+    ).one_or_none()
+
+    if row is None:
+        return None
+
+    values = row._asdict()
+    values["specialties"] = [SpecialtySnapshot(**s)
+                             for s in values["specialties"]]
+
+    return CafeSnapshot(**values)
+
+
+#######################################
+# validators: cheap values that change whenever a page would, for ETags
+
+
+def get_cafe_validator(cafe_id):
+    """Return tuple that changes whenever cafe's detail would (the cafe,
+    its city or its specialties change), or None if there's no such cafe.
+
+    Built from versions, which every update bumps, rather than updated_at:
+    that's when a transaction started, so a later commit can have an
+    earlier time. A specialty added or deleted changes the count, or
+    (both at once) the newest id.
+
+    One query, using indexes and loading no objects.
+    """
+
+    def of_specialties(column):
+        return (select(column).where(Specialty.cafe_id == cafe_id)
+                .scalar_subquery())
+
+    row = db.session.execute(
+        select(Cafe.version, City.version,
+               of_specialties(func.count(Specialty.id)),
+               of_specialties(func.sum(Specialty.version)),
+               of_specialties(func.max(Specialty.id)))
+        .join(City, City.code == Cafe.city_code)
+        .where(Cafe.id == cafe_id)
+    ).one_or_none()
+
+    return None if row is None else tuple(row)
+
+
+def get_cafes_validator(likes=False):
+    """Return tuple that changes whenever any page of cafes would (a cafe is
+    added, changed or deleted, or a city changes), or if likes, whenever a
+    like count does too (for pages showing or sorted by them).
+
+    Made of catalog versions, bumped along with those changes (see
+    models.CatalogVersion): one primary key lookup, however many cafes.
+    The second is the cities' version, for CityRegistry.sync.
+    """
+
+    return CatalogVersion.get_many(
+        ["cafe-list", "cities"] + (["like-counts"] if likes else []))
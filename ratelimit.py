@@ -0,0 +1,225 @@
+"""Login rate limiting for Flask Cafe.
+
+Every login attempt costs a bcrypt check, so a burst of attempts (e.g.
+credential stuffing) is a burst of CPU. Attempts are admitted through token
+buckets, one per username and one per client IP: each bucket holds up to
+`burst` tokens, refills at burst / period tokens a second, and an attempt
+takes one token from each. An empty bucket means the attempt is turned away
+before any hashing is done.
+"""
+
+import sqlite3
+import threading
+import time
+
+from metrics import metrics
+
+
+def take_token(tokens, updated, now, burst, rate):
+    """Refill a bucket with `tokens` left at time `updated` up to now, then
+    try to take one token.
+
+    Returns (tokens left, retry_after): retry_after is 0 if a token was
+    taken, else the seconds until one will be available.
+    """
+
+    if updated is None:
+        tokens = burst
+    else:
+        tokens = min(burst, tokens + (now - updated) * rate)
+
+    if tokens >= 1:
+        return tokens - 1, 0
+
+    return tokens, (1 - tokens) / rate
+
+
+class MemoryBackend:
+    """Token buckets kept in this process only."""
+
+    clock = staticmethod(time.monotonic)
+
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def take(self, key, burst, rate):
+        """Take a token from key's bucket; return retry_after (see
+        take_token).
+        """
+
+        now = self.clock()
+
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (None, None))
+            tokens, retry_after = take_token(tokens, updated, now, burst, rate)
+            self._buckets[key] = (tokens, now)
+
+            if len(self._buckets) > self.maxsize:
+                self._prune(now, burst, rate)
+
+        return retry_after
+
+    def reset(self):
+        """Empty every bucket's history (all start full again)."""
+
+        with self._lock:
+            self._buckets.clear()
+
+    def _prune(self, now, burst, rate):
+        """Forget buckets that would be full again by now."""
+
+        full_after = burst / rate
+        self._buckets = {
+            key: (tokens, updated)
+            for key, (tokens, updated) in self._buckets.items()
+            if now - updated < full_after
+        }
+
+
+class SQLiteBackend:
+    """Token buckets in an SQLite file, shared by every worker process on
+    this host that uses the same path.
+    """
+
+    clock = staticmethod(time.time)
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+        with self._connect() as conn:
+            conn.execute("""CREATE TABLE IF NOT EXISTS buckets (
+                                key TEXT PRIMARY KEY,
+                                tokens REAL NOT NULL,
+                                updated REAL NOT NULL)""")
+
+    def take(self, key, burst, rate):
+        """Take a token from key's bucket; return retry_after (see
+        take_token).
+        """
+
+        conn = self._connect()
+        now = self.clock()
+
+        # IMMEDIATE takes the write lock up front, so concurrent workers
+        # can't both read the same bucket before either writes it
+        conn.execute("BEGIN IMMEDIATE")
+
+        try:
+            row = conn.execute(
+                "SELECT tokens, updated FROM buckets WHERE key = ?",
+                (key,)).fetchone()
+            tokens, retry_after = take_token(
+                *(row or (None, None)), now, burst, rate)
+            conn.execute(
+                "INSERT OR REPLACE INTO buckets VALUES (?, ?, ?)",
+                (key, tokens, now))
+            conn.execute(
+                "DELETE FROM buckets WHERE updated < ?",
+                (now - burst / rate,))
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+        conn.execute("COMMIT")
+        return retry_after
+
+    def reset(self):
+        """Empty every bucket's history (all start full again)."""
+
+        with self._connect() as conn:
+            conn.execute("DELETE FROM buckets")
+
+    def _connect(self):
+        """Return this thread's connection (in autocommit mode)."""
+
+        conn = getattr(self._local, "conn", None)
+
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5,
+                                   isolation_level=None)
+            self._local.conn = conn
+
+        return conn
+
+
+def make_backend(storage):
+    """Return backend for a storage setting: "memory" or "sqlite:///path"."""
+
+    if storage == "memory":
+        return MemoryBackend()
+
+    if storage.startswith("sqlite:///"):
+        return SQLiteBackend(storage[len("sqlite:///"):])
+
+    raise ValueError(f"Unknown rate limit storage: {storage}")
+
+
+class LoginLimiter:
+    """Admits login attempts by username & client IP.
+
+    Config:
+        LOGIN_RATE_LIMIT_STORAGE: "memory" (the default; per process) or
+            "sqlite:///path/to/file.db" (shared by workers on this host)
+        LOGIN_USERNAME_BURST: attempts in a row for one username (default 5)
+        LOGIN_IP_BURST: attempts in a row from one IP (default 20)
+        LOGIN_RATE_PERIOD: seconds for an emptied bucket to refill
+            (default 300)
+    """
+
+    def __init__(self, app=None):
+        self.storage = "memory"
+        self.backend = MemoryBackend()
+        self.username_burst = 5
+        self.ip_burst = 20
+        self.period = 300
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Configure from this Flask app's config."""
+
+        self.storage = app.config.get('LOGIN_RATE_LIMIT_STORAGE', "memory")
+        self.backend = make_backend(self.storage)
+        self.username_burst = app.config.get('LOGIN_USERNAME_BURST', 5)
+        self.ip_burst = app.config.get('LOGIN_IP_BURST', 20)
+        self.period = app.config.get('LOGIN_RATE_PERIOD', 300)
+
+        app.extensions['login_limiter'] = self
+
+    def check(self, username, ip):
+        """Take a token for this login attempt.
+
+        Returns 0 if the attempt may go ahead, else the seconds until one
+        will be allowed.
+        """
+
+        retry_after = (
+            self._take(f"ip:{ip}", self.ip_burst)
+            or self._take(f"user:{username.lower()}", self.username_burst))
+
+        if retry_after:
+            metrics.incr("login.throttled")
+
+        return retry_after
+
+    def reset(self):
+        """Refill every bucket."""
+
+        self.backend.reset()
+
+    def after_fork(self):
+        """Start over with a backend of our own (call in a forked child):
+        SQLite connections can't be shared with the parent.
+        """
+
+        self.backend = make_backend(self.storage)
+
+    def _take(self, key, burst):
+        return self.backend.take(key, burst, burst / self.period)
+
+
+login_limiter = LoginLimiter()
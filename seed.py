@@ -2,10 +2,14 @@
 
 from models import City, Cafe, db, User, Specialty
 
-from app import app
+from app import create_app
+from migrations import migrate
+
+app = create_app()
+app.app_context().push()
 
 db.drop_all()
-db.create_all()
+migrate()
 
 
 #######################################
@@ -122,6 +126,10 @@ ua.liked_cafes.append(c1)
 
 db.session.commit()
 
+# likes added through the relationship don't update cafes' like counts
+Cafe.reconcile_like_counts()
+db.session.commit()
+
 
 #######################################
 # cafe maps
@@ -18,41 +18,18 @@ const tooltipList = [...$tooltipTriggerList].map(
 const $cafeDetails = $("#cafe-details");
 const $userLikedCafesList = $("#user-liked-cafes")
 
-/******************************************************************************
- * checkIfCafeIsLiked: Makes API request to check if the current cafe is liked. 
- *    Accepts: cafe_id (int)
- *    Returns: true || false
-*/
-async function checkIfCafeIsLiked(cafeId) {
-
-  const params = new URLSearchParams({ "cafe_id": cafeId })
-  const response = await fetch(`${BASE_API_URL}likes?${params}`,
-    { method: "GET" });
-  const resp_data = await response.json();
-  // console.log("resp_data: ", resp_data);
-  return resp_data.likes === true;
-}
-
-/** toggleLike: Makes API request to add/remove the current cafe to/from the 
- * user's likes.
- *    Accepts: 
- *        cafe_id (int) - current cafe's id
- *        endpoint(str) - to add to the BASE_API_URL ("like" or "unlike")
- *    Returns: JSON 
- *        If endpoint is "/like" : {"liked": <cafe_id>} 
- *        If endpoint is "/unlike": {"unliked": <cafe_id>}
+/** setLike: Makes API request to set whether the user likes the cafe. Safe
+ * to repeat: liking an already-liked cafe leaves it liked.
+ *    Accepts:
+ *        cafeId (int) - current cafe's id
+ *        liked (bool) - true to like the cafe, false to unlike it
+ *    Returns: JSON
+ *        {"cafe_id": <cafe_id>, "liked": true|false, "like_count": <int>}
  */
-async function toggleLike(cafeId, endpoint) {
-  // console.log("endpoint: ", endpoint);
+async function setLike(cafeId, liked) {
   const response = await fetch(
-    `${BASE_API_URL}${endpoint}`,
-    {
-      method: "POST",
-      body: JSON.stringify({ "cafe_id": cafeId }),
-      headers: {
-        "Content-Type": "application/json"
-      },
-    });
+    `${BASE_API_URL}cafes/${cafeId}/like`,
+    { method: liked ? "PUT" : "DELETE" });
   const resp_data = await response.json();
   // console.log("resp_data: ", resp_data);
   return resp_data;
@@ -60,7 +37,8 @@ async function toggleLike(cafeId, endpoint) {
 
 /** handleLikeClick: makes an AJAX call to the API to change the like/unlike
 *  status, then changes the button to show updated status without refreshing
-* the page.
+* the page. The button's data-liked attribute holds the current status, so a
+* click costs a single request.
 */
 async function handleLikeClick(evt) {
   evt.preventDefault();
@@ -68,17 +46,17 @@ async function handleLikeClick(evt) {
   const $evtTarget = $(evt.target);
   const $toggleLikeBtn = $evtTarget.closest(".toggle-like-btn");
   const cafeId = $toggleLikeBtn.data("cafe-id");
+  const cafeIsLiked = $toggleLikeBtn.data("liked") === true;
 
-  const cafeIsLiked = await checkIfCafeIsLiked(cafeId);
+  const { liked } = await setLike(cafeId, !cafeIsLiked);
+  $toggleLikeBtn.data("liked", liked);
 
-  if (cafeIsLiked) {
-    await toggleLike(cafeId, "unlike");
+  if (liked) {
     $toggleLikeBtn
-      .html('<i class="bi bi-heart"></i> Like');
+      .html('<i class="bi bi-heart-fill"></i>');
   } else {
-    await toggleLike(cafeId, "like");
     $toggleLikeBtn
-      .html('<i class="bi bi-heart-fill"></i>');
+      .html('<i class="bi bi-heart"></i> Like');
   }
 }
 
@@ -87,3 +65,61 @@ $cafeDetails.on("click", ".toggle-like-btn", handleLikeClick);
 //For the like buttons on user profile page
 $userLikedCafesList.on("click", ".toggle-like-btn", handleLikeClick);
 
+
+/******************************************************************************
+ * Shared pages
+ */
+
+/** fillUserState: shared pages (<body data-shared-page>) are the same for
+ * everyone, so may come from a cache. Fills in what's the user's own with a
+ * single API request: navbar, flashed messages, like buttons & admin
+ * controls.
+ */
+async function fillUserState() {
+  if (!$("body").is("[data-shared-page]")) return;
+
+  const cafeIds = [...new Set(
+    $("[data-cafe-id]").map((i, el) => $(el).data("cafe-id")).get())];
+  const response = await fetch(
+    `${BASE_API_URL}me/state?cafe_ids=${cafeIds.join(",")}`,
+    { cache: "no-store" });
+  const { user, likes, flashes, csrf_token } = await response.json();
+
+  for (const [category, msg] of flashes) {
+    $("#flashes").append(
+      $("<div>").addClass(`mb-3 alert alert-${category}`).text(msg));
+  }
+
+  if (!user) return;
+
+  $("#user-nav").empty().append(
+    $("<li>").append(
+      $("<a>", { href: "/profile", class: "nav-link" }).text(user.full_name)),
+    $("<form>", {
+      class: "form-inline ml-auto my-2 my-lg-0",
+      action: "/logout",
+      method: "POST",
+    }).append(
+      $("<input>", { type: "hidden", name: "csrf_token", value: csrf_token }),
+      $("<button>", { class: "btn-sm btn btn-outline-light" }).text("Log Out")));
+
+  $(".anon-like-btn").each((i, el) => {
+    const cafeId = $(el).data("cafe-id");
+    const liked = likes[cafeId] === true;
+    const $toggleLikeBtn = $("<a>", {
+      "data-cafe-id": cafeId,
+      class: "toggle-like-btn btn btn-outline-primary",
+      href: "FOR-AJAX",
+      "aria-label": liked ? "Unlike" : "Like",
+    }).data("liked", liked);
+
+    $toggleLikeBtn.html(
+      liked ? '<i class="bi bi-heart-fill"></i>' : '<i class="bi bi-heart"></i> Like');
+    bootstrap.Tooltip.getInstance(el)?.dispose();
+    $(el).replaceWith($toggleLikeBtn);
+  });
+
+  if (user.admin) $(".admin-only").removeClass("d-none");
+}
+
+fillUserState();
@@ -6,20 +6,35 @@ import os
 os.environ["DATABASE_URL"] = "postgresql:///flaskcafe_test"
 
 import re
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from unittest import TestCase
-
-from flask import session
-from app import app, CURR_USER_KEY
-from models import db, Cafe, City, connect_db, User, Like
-
-# Make Flask errors be real errors, rather than HTML pages with error info
-app.config['TESTING'] = True
-
-# This is a bit of hack, but don't use Flask DebugToolbar
-app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
-
-# Don't req CSRF for testing
-app.config['WTF_CSRF_ENABLED'] = False
+from unittest.mock import patch
+
+from sqlalchemy import create_engine, event, exc, text
+
+from flask import Flask, session
+from app import create_app, warm_up, after_fork, CURR_USER_KEY, user_cache
+from cache import LOCK_STRIPES, SingleFlight, TaggedCache, page_cache
+from cache import make_backend as make_cache_backend
+from hashing import PasswordHasher, HasherBusy, get_work_factor
+from hashing import hash_password
+from metrics import metrics
+from migrations import migrate, status
+from pooling import engine_options, InstrumentedQueuePool
+from pooling import InstrumentedNullPool
+from ratelimit import MemoryBackend, SQLiteBackend, login_limiter
+from models import db, Cafe, City, connect_db, User, Like, city_registry
+from models import CatalogVersion, Specialty
+
+# TESTING on, CSRF & DebugToolbar off: see config.TestingConfig
+app = create_app("testing")
+
+# Tests use the database outside of requests
+app.app_context().push()
 
 db.drop_all()
 db.create_all()
@@ -44,6 +59,25 @@ def login_for_test(client, user_id):
         sess[CURR_USER_KEY] = user_id
 
 
+@contextmanager
+def count_queries(engine=None):
+    """Count SQL statements run inside the block (on this engine, default
+    db.engine); yields a list of them.
+    """
+
+    engine = engine or db.engine
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, "before_cursor_execute", before_cursor_execute)
+
+
 #######################################
 # data to use for test objects / testing forms
 
@@ -119,6 +153,218 @@ ADMIN_USER_DATA = dict(
 )
 
 
+#######################################
+# app factory
+
+
+class CreateAppTestCase(TestCase):
+    """Tests for create_app's config profiles."""
+
+    def test_production(self):
+        prod_app = create_app("production")
+
+        self.assertFalse(prod_app.config['SQLALCHEMY_ECHO'])
+        self.assertNotIn("debugtoolbar", prod_app.blueprints)
+
+        with prod_app.app_context():
+            self.assertFalse(db.engine.echo)
+            self.assertIsInstance(db.engine.pool, InstrumentedQueuePool)
+            self.assertEqual(db.engine.pool.size(), 5)
+
+    def test_pool_metrics(self):
+        metrics.reset()
+        engine = create_engine(
+            os.environ["DATABASE_URL"],
+            **engine_options(pool_size=1, max_overflow=1, pool_timeout=0.1))
+        self.assertIsInstance(engine.pool, InstrumentedQueuePool)
+
+        try:
+            first = engine.connect()
+            second = engine.connect()
+            second.execute(text("SELECT 1"))
+
+            with self.assertRaises(exc.TimeoutError):
+                engine.connect()
+
+            snapshot = metrics.snapshot()
+            self.assertEqual(snapshot["gauges"]["db.pool.default.checked_out"], 2)
+            self.assertEqual(snapshot["counters"]["db.pool.default.overflow"], 1)
+            self.assertEqual(snapshot["counters"]["db.pool.default.timeout"], 1)
+            self.assertEqual(snapshot["timings"]["db.pool.default.wait"]["count"], 3)
+            self.assertEqual(snapshot["timings"]["db.query.default"]["count"], 1)
+
+            first.close()
+            second.close()
+            self.assertEqual(
+                metrics.snapshot()["gauges"]["db.pool.default.checked_out"], 0)
+        finally:
+            engine.dispose()
+
+    def test_pool_metrics_per_bind(self):
+        replica_app = create_app("testing", {
+            "SQLALCHEMY_BINDS": {"replica": os.environ["DATABASE_URL"]},
+        })
+        metrics.reset()
+
+        with replica_app.app_context():
+            replica = db.engines["replica"]
+            self.assertIsInstance(replica.pool, InstrumentedQueuePool)
+
+            with replica.connect() as conn:
+                conn.execute(text("SELECT 1"))
+                gauges = metrics.snapshot()["gauges"]
+                self.assertEqual(gauges["db.pool.replica.checked_out"], 1)
+                self.assertNotIn("db.pool.default.checked_out", gauges)
+
+            timings = metrics.snapshot()["timings"]
+            self.assertEqual(timings["db.query.replica"]["count"], 1)
+
+    def test_pgbouncer_mode(self):
+        engine = create_engine(os.environ["DATABASE_URL"],
+                               **engine_options(pgbouncer=True))
+        self.assertIsInstance(engine.pool, InstrumentedNullPool)
+
+        with engine.connect() as conn:
+            self.assertEqual(conn.scalar(text("SELECT 1")), 1)
+
+    def test_development(self):
+        dev_app = create_app("development")
+
+        self.assertTrue(dev_app.config['SQLALCHEMY_ECHO'])
+        self.assertIn("debugtoolbar", dev_app.blueprints)
+
+    def test_unknown_config(self):
+        with self.assertRaises(ValueError):
+            create_app("staging")
+
+
+class PreforkTestCase(TestCase):
+    """Tests for warming up in a pre-fork parent & resetting in workers."""
+
+    def setUp(self):
+        self.app = create_app("testing")
+
+    def test_warm_up(self):
+        city_registry._cities = None
+
+        warm_up(self.app)
+
+        self.assertIsNotNone(city_registry._cities)
+        cached = [name for _, name in self.app.jinja_env.cache.keys()]
+        self.assertIn("cafe/list.html", cached)
+
+        with self.app.app_context():
+            self.assertEqual(db.engine.pool.checkedout(), 0)
+
+    def test_after_fork(self):
+        with self.app.app_context():
+            db.session.execute(text("SELECT 1"))
+            parent_pool = db.engine.pool
+
+            pid = os.fork()
+
+            if pid == 0:  # pragma: no cover
+                # worker: inherited connections dropped, not shared
+                after_fork(self.app)
+                ok = (db.engine.pool is not parent_pool
+                      and db.session.scalar(text("SELECT 1")) == 1)
+                os._exit(0 if ok else 1)
+
+            _, status = os.waitpid(pid, 0)
+            self.assertEqual(os.waitstatus_to_exitcode(status), 0)
+
+            # the parent's connection still works
+            self.assertEqual(db.session.scalar(text("SELECT 1")), 1)
+            db.session.remove()
+
+
+class MigrationsTestCase(TestCase):
+    """Tests for the schema migration runner, in a schema of its own."""
+
+    def setUp(self):
+        with db.engine.begin() as conn:
+            conn.execute(text("DROP SCHEMA IF EXISTS migrations_test CASCADE"))
+            conn.execute(text("CREATE SCHEMA migrations_test"))
+
+        self.engine = create_engine(
+            os.environ["DATABASE_URL"],
+            connect_args={"options": "-csearch_path=migrations_test"})
+
+    def tearDown(self):
+        self.engine.dispose()
+
+        with db.engine.begin() as conn:
+            conn.execute(text("DROP SCHEMA migrations_test CASCADE"))
+
+    def get_indexes(self):
+        with self.engine.connect() as conn:
+            return set(conn.scalars(text(
+                "SELECT indexname FROM pg_indexes "
+                "WHERE schemaname = 'migrations_test'")))
+
+    def test_new_database(self):
+        self.assertEqual(migrate(self.engine), [])
+
+        self.assertIn("ix_cafes_users_liking_users", self.get_indexes())
+        self.assertTrue(all(applied for _, _, applied in status(self.engine)))
+
+    def test_existing_database(self):
+        # the schema from before like counts & indexes, with a like
+        with self.engine.begin() as conn:
+            db.metadata.create_all(conn)
+            conn.execute(text("ALTER TABLE cafes DROP COLUMN like_count"))
+            for table in ["cities", "cafes", "specialties"]:
+                conn.execute(text(
+                    f"ALTER TABLE {table} DROP COLUMN version, "
+                    f"DROP COLUMN updated_at"))
+            conn.execute(text("ALTER TABLE specialties DROP COLUMN type_rank"))
+            conn.execute(text("DROP TABLE catalog_versions"))
+            for index in ["ix_cafes_name_id", "ix_cafes_city_code",
+                          "ix_cafes_users_liking_users"]:
+                conn.execute(text(f"DROP INDEX {index}"))
+            conn.execute(text("""
+                INSERT INTO cities VALUES ('sf', 'San Francisco', 'CA');
+                INSERT INTO cafes
+                    VALUES (1, 'Cafe', '', '', '1 Main St', 'sf', '');
+                INSERT INTO users
+                    VALUES (1, 'test', false, 'a@b.com', 'Test', 'User', '',
+                            '', 'x');
+                INSERT INTO cafes_users VALUES (1, 1);
+                INSERT INTO specialties (name, cafe_id, type, description,
+                                         image_url)
+                    VALUES ('Latte', 1, 'dessert', '', '')"""))
+
+        self.assertEqual(migrate(self.engine), [
+            "add_cafes_like_count",
+            "add_cafe_sort_indexes",
+            "add_foreign_key_indexes",
+            "add_specialties_type_rank",
+            "add_specialties_type_rank_index",
+            "add_cafes_version",
+            "add_updated_at",
+            "add_city_and_specialty_versions",
+            "add_catalog_versions",
+        ])
+        self.assertEqual(migrate(self.engine), [])
+
+        indexes = self.get_indexes()
+        self.assertLessEqual(
+            {"ix_cafes_name_id", "ix_cafes_like_count_id",
+             "ix_cafes_city_code", "ix_specialties_cafe_id_type_rank_name",
+             "ix_cafes_users_liking_users"},
+            indexes)
+        self.assertNotIn("ix_specialties_cafe_id", indexes)
+
+        with self.engine.connect() as conn:
+            self.assertEqual(
+                conn.scalar(text("SELECT like_count FROM cafes")), 1)
+            self.assertEqual(
+                conn.scalar(text("SELECT type_rank FROM specialties")), 1)
+            for table in ["cities", "cafes", "specialties"]:
+                self.assertEqual(
+                    conn.scalar(text(f"SELECT version FROM {table}")), 1)
+
+
 #######################################
 # homepage
 
@@ -167,6 +413,25 @@ class CityModelTestCase(TestCase):
     def test_get_choices_cities(self):
         self.assertEqual(City.get_choices_cities(), [('sf', 'San Francisco')])
 
+    def test_registry_reads_without_queries(self):
+        city_registry.load()
+        db.session.refresh(self.cafe)
+
+        with count_queries() as queries:
+            City.get_choices_cities()
+            self.cafe.get_city_state()
+
+        self.assertEqual(queries, [])
+
+    def test_registry_refreshes_on_commit(self):
+        City.query.get("sf").name = "San Fran"
+        db.session.add(City(code="berk", name="Berkeley", state="CA"))
+        db.session.commit()
+
+        self.assertEqual(City.get_choices_cities(),
+                         [('berk', 'Berkeley'), ('sf', 'San Fran')])
+        self.assertEqual(city_registry.get("sf"), ("San Fran", "CA"))
+
 
 #######################################
 # cafes
@@ -224,6 +489,7 @@ class CafeViewsTestCase(TestCase):
     def tearDown(self):
         """After each test, remove all cafes."""
 
+        Specialty.query.delete()
         Cafe.query.delete()
         City.query.delete()
         db.session.commit()
@@ -241,6 +507,249 @@ class CafeViewsTestCase(TestCase):
             self.assertIn(b"Test Cafe", resp.data)
             self.assertIn(b'testcafe.com', resp.data)
 
+    def test_detail_specialties_by_type(self):
+        db.session.add_all([
+            Specialty(name=name, type=type, cafe_id=self.cafe_id)
+            for name, type in [("Fries", "side"), ("Mocha", "beverage"),
+                               ("Cake", "dessert"), ("Latte", "beverage")]
+        ])
+        db.session.commit()
+
+        try:
+            with app.test_client() as client:
+                with count_queries() as queries:
+                    resp = client.get(f"/cafes/{self.cafe_id}")
+
+            html = resp.get_data(as_text=True)
+            positions = [html.index(text) for text in
+                         ["beverages", "Latte", "Mocha", "desserts", "Cake",
+                          "sides", "Fries"]]
+            self.assertEqual(positions, sorted(positions))
+            self.assertNotIn("courses", html)
+
+            [specialties_query] = [q for q in queries if "type_rank" in q]
+            self.assertIn(
+                "ORDER BY specialties.type_rank, specialties.name",
+                specialties_query)
+        finally:
+            Specialty.query.delete()
+            db.session.commit()
+
+    def test_list_query_count(self):
+        with app.test_client() as client:
+            with count_queries() as one_cafe:
+                client.get("/cafes")
+
+        db.session.add_all([
+            City(code="oak", name="Oakland", state="CA"),
+            Cafe(**CAFE_DATA_NEW),
+            Cafe(**{**CAFE_DATA_NEW, "name": "Oak Cafe", "city_code": "oak"}),
+        ])
+        db.session.commit()
+        db.session.expunge_all()
+
+        with app.test_client() as client:
+            with count_queries() as three_cafes:
+                resp = client.get("/cafes")
+
+        self.assertIn(b"Oakland, CA", resp.data)
+        self.assertEqual(len(three_cafes), len(one_cafe))
+
+    def test_pages_cached_until_changed(self):
+        with app.test_client() as client:
+            client.get("/cafes")
+            client.get(f"/cafes/{self.cafe_id}")
+
+            with count_queries() as queries:
+                client.get("/cafes")
+                client.get(f"/cafes/{self.cafe_id}")
+            # just checking the pages' ETags
+            self.assertEqual(len(queries), 2)
+
+            Cafe.query.get(self.cafe_id).name = "Renamed Cafe"
+            db.session.commit()
+            self.assertIn(b"Renamed Cafe", client.get("/cafes").data)
+
+            db.session.add(Specialty(name="Latte", type="beverage",
+                                     cafe_id=self.cafe_id))
+            db.session.commit()
+            self.assertIn(b"Latte", client.get(f"/cafes/{self.cafe_id}").data)
+
+            City.query.get("sf").name = "San Fran"
+            db.session.commit()
+            self.assertIn(b"San Fran, CA", client.get("/cafes").data)
+            self.assertIn(b"San Fran, CA",
+                          client.get(f"/cafes/{self.cafe_id}").data)
+
+    def test_conditional_get(self):
+        with app.test_client() as client:
+            # url -> does it show (or sort by) like counts?
+            for url, shows_likes in [("/cafes", False),
+                                     (f"/cafes/{self.cafe_id}", False),
+                                     ("/cafes?sort=popular", True),
+                                     ("/api/cafes", True)]:
+                etag = client.get(url).headers["ETag"]
+
+                with count_queries() as queries:
+                    resp = client.get(url, headers={"If-None-Match": etag})
+                self.assertEqual(resp.status_code, 304)
+                self.assertEqual(resp.headers["ETag"], etag)
+                self.assertEqual(len(queries), 1)
+
+                Cafe.change_like_count(self.cafe_id, 1)
+                db.session.commit()
+                resp = client.get(url, headers={"If-None-Match": etag})
+                self.assertEqual(resp.status_code,
+                                 200 if shows_likes else 304)
+                self.assertEqual(resp.headers["ETag"] != etag, shows_likes)
+
+            # editing a specialty changes neither count nor newest id
+            specialty = Specialty(name="Latte", type="beverage",
+                                  cafe_id=self.cafe_id)
+            db.session.add(specialty)
+            db.session.commit()
+            url = f"/cafes/{self.cafe_id}"
+            etag = client.get(url).headers["ETag"]
+            specialty.name = "Mocha"
+            db.session.commit()
+            resp = client.get(url, headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn(b"Mocha", resp.data)
+
+            # as sent on by a proxy that compressed the response
+            etag = client.get("/cafes").headers["ETag"]
+            resp = client.get("/cafes", headers={"If-None-Match": f"W/{etag}"})
+            self.assertEqual(resp.status_code, 304)
+
+            self.assertEqual(client.get("/cafes/0").status_code, 404)
+
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 1
+            self.assertNotIn("ETag", client.get("/cafes").headers)
+
+    def test_catalog_versions_bumped_with_changes(self):
+        def versions():
+            return CatalogVersion.get_many(["cafe-list", "like-counts"])
+
+        before = versions()
+        Cafe.change_like_count(self.cafe_id, 1)
+        db.session.commit()
+        liked = versions()
+        self.assertEqual(liked[0], before[0])
+        self.assertNotEqual(liked[1], before[1])
+
+        City.query.get("sf").name = "San Fran"
+        db.session.commit()
+        renamed = versions()
+        self.assertNotEqual(renamed[0], liked[0])
+
+        # bumped in the same transaction, so rolled back with it
+        db.session.add(Cafe(**CAFE_DATA_NEW))
+        db.session.flush()
+        self.assertNotEqual(versions(), renamed)
+        db.session.rollback()
+        self.assertEqual(versions(), renamed)
+
+    def test_pages_cached_by_etag(self):
+        with app.test_client() as client:
+            for url in ["/cafes", f"/cafes/{self.cafe_id}"]:
+                etag = client.get(url).headers["ETag"]
+
+                # changed by another process, whose invalidation this one's
+                # memory cache doesn't see
+                with db.engine.begin() as conn:
+                    conn.execute(text(
+                        "UPDATE cafes SET name = name || '!', "
+                        "version = version + 1"))
+                    conn.execute(text(
+                        "UPDATE catalog_versions SET version = version + 1"))
+
+                resp = client.get(url)
+                self.assertNotEqual(resp.headers["ETag"], etag)
+                self.assertIn(b"Test Cafe!", resp.data)
+
+    def test_list_sees_cities_changed_elsewhere(self):
+        with app.test_client() as client:
+            self.assertIn(b"San Francisco, CA", client.get("/cafes").data)
+
+            # renamed by another process, whose invalidation & registry
+            # reload this one doesn't see
+            with db.engine.begin() as conn:
+                conn.execute(text(
+                    "UPDATE cities SET name = 'San Fran', "
+                    "version = version + 1"))
+                conn.execute(text(
+                    "UPDATE catalog_versions SET version = version + 1"))
+
+            self.assertIn(b"San Fran, CA", client.get("/cafes").data)
+
+    def test_list_renders_only_edited_cards(self):
+        db.session.add(Cafe(**CAFE_DATA_NEW))
+        db.session.commit()
+
+        with app.test_client() as client:
+            client.get("/cafes")
+
+            Cafe.query.get(self.cafe_id).description = "Now with pastries"
+            db.session.commit()
+            metrics.reset()
+
+            resp = client.get("/cafes")
+
+        self.assertIn(b"Now with pastries", resp.data)
+        self.assertIn(CAFE_DATA_NEW["name"].encode(), resp.data)
+        self.assertEqual(
+            metrics.snapshot()["counters"]["cafe_list.cards_rendered"], 1)
+
+    def test_list_later_pages_not_cached_whole(self):
+        db.session.add(Cafe(**CAFE_DATA_NEW))
+        db.session.commit()
+        cafes, cursor = Cafe.get_page(limit=1)
+
+        with app.test_client() as client, \
+                patch.object(page_cache, "get_or_set") as get_or_set:
+            resp = client.get("/cafes", query_string={"after": cursor})
+
+        self.assertIn(b"Test Cafe", resp.data)
+        get_or_set.assert_not_called()
+
+    def test_list_invalid_cursor(self):
+        with app.test_client() as client:
+            # not base64 JSON; ["a\u0000", 1], with a NUL Postgres rejects
+            for cursor in ["not-a-cursor", "WyJhXHUwMDAwIiwgMV0"]:
+                resp = client.get("/cafes", query_string={"after": cursor})
+                self.assertEqual(resp.status_code, 400)
+
+    def test_api_list_pages(self):
+        another = Cafe(**CAFE_DATA_NEW)
+        db.session.add(another)
+        db.session.commit()
+
+        with app.test_client() as client:
+            resp = client.get("/api/cafes", query_string={"limit": 1})
+            data = resp.json
+
+            self.assertEqual([c["name"] for c in data["cafes"]],
+                             ["Another Cafe"])
+            self.assertIsNotNone(data["next"])
+
+            resp = client.get("/api/cafes",
+                              query_string={"limit": 1, "after": data["next"]})
+            data = resp.json
+
+            self.assertEqual([c["id"] for c in data["cafes"]], [self.cafe_id])
+            self.assertIsNone(data["next"])
+
+    def test_api_list_invalid_params(self):
+        with app.test_client() as client:
+            resp = client.get("/api/cafes", query_string={"limit": 0})
+            self.assertEqual(resp.status_code, 400)
+            self.assertEqual(resp.json, {"error": "Invalid limit"})
+
+            resp = client.get("/api/cafes", query_string={"after": "bad"})
+            self.assertEqual(resp.status_code, 400)
+            self.assertEqual(resp.json, {"error": "Invalid cursor"})
+
 
 class CafeAdminViewsTestCase(TestCase):
     """Tests for add/edit views on cafes."""
@@ -468,12 +977,279 @@ class UserModelTestCase(TestCase):
         db.session.rollback()
 
 
+class PasswordHasherTestCase(TestCase):
+    """Tests for hashing passwords in a process pool."""
+
+    def setUp(self):
+        pool_app = Flask(__name__)
+        pool_app.config['BCRYPT_POOL_SIZE'] = 1
+        pool_app.config['BCRYPT_POOL_MAX_PENDING'] = 1
+
+        self.hasher = PasswordHasher(pool_app)
+
+    def tearDown(self):
+        self.hasher.shutdown()
+
+    def test_hash_and_check_in_pool(self):
+        metrics.reset()
+
+        hashed = self.hasher.hash("secret", 4)
+
+        self.assertEqual(hashed[:7], "$2b$04$")
+        self.assertTrue(self.hasher.check(hashed, "secret"))
+        self.assertFalse(self.hasher.check(hashed, "wrong"))
+
+        timings = metrics.snapshot()["timings"]
+        self.assertEqual(timings["bcrypt.hash_password"]["count"], 1)
+        self.assertEqual(timings["bcrypt.check_password"]["count"], 2)
+
+    def test_broken_pool_replaced(self):
+        hashed = self.hasher.hash("secret", 4)
+
+        with ThreadPoolExecutor(1) as executor:
+            # a slow hash, killed (as if out of memory) while it runs
+            hashing = executor.submit(self.hasher.hash, "secret", 16)
+
+            while not self.hasher._pending:
+                time.sleep(.01)
+
+            for process in self.hasher._executor._processes.values():
+                process.kill()
+
+            with self.assertRaises(HasherBusy):
+                hashing.result()
+
+        # the next hashes start a new pool
+        self.assertTrue(self.hasher.check(hashed, "secret"))
+        self.assertTrue(self.hasher.check(hashed, "secret"))
+
+    def test_saturated_pool_fails_fast(self):
+        self.hasher._pending = 1
+
+        with self.assertRaises(HasherBusy):
+            self.hasher.hash("secret", 4)
+
+    def test_needs_rehash(self):
+        self.assertEqual(self.hasher.work_factor, 9)
+        self.assertEqual(get_work_factor(hash_password("secret", 4)), 4)
+
+        self.assertTrue(self.hasher.needs_rehash(hash_password("secret", 4)))
+        self.assertFalse(self.hasher.needs_rehash(hash_password("secret", 9)))
+
+    def test_hash_in_background_skipped_when_busy(self):
+        self.hasher._pending = 1
+
+        self.assertIsNone(self.hasher.hash_in_background("secret", print))
+
+    def test_hash_in_background_off_pool_thread(self):
+        self.hasher.work_factor = 4
+
+        def on_hashed(hashed):
+            return threading.current_thread().name, hashed[:7]
+
+        future = self.hasher.hash_in_background("secret", on_hashed)
+        thread_name, prefix = future.result(timeout=10)
+
+        self.assertTrue(thread_name.startswith("bcrypt"))
+        self.assertEqual(prefix, "$2b$04$")
+
+    def test_hash_in_background_bounded_without_pool(self):
+        hasher = PasswordHasher()
+        hasher.work_factor = 4
+        hasher.background_max_pending = 2
+        release = threading.Event()
+
+        try:
+            first = hasher.hash_in_background(
+                "secret", lambda hashed: release.wait(10), key="user:1")
+
+            # the same user's upgrade is pending already
+            self.assertIsNone(
+                hasher.hash_in_background("secret", print, key="user:1"))
+
+            second = hasher.hash_in_background("secret", len, key="user:2")
+            self.assertIsNotNone(second)
+            # the queue is full
+            self.assertIsNone(
+                hasher.hash_in_background("secret", print, key="user:3"))
+
+            release.set()
+            first.result(timeout=10)
+            second.result(timeout=10)
+
+            again = hasher.hash_in_background("secret", len, key="user:1")
+            self.assertEqual(again.result(timeout=10), 60)
+        finally:
+            release.set()
+            hasher.shutdown()
+
+
+class RateLimitTestCase(TestCase):
+    """Tests for login token buckets."""
+
+    def check_backend(self, backend):
+        now = [1000.0]
+        backend.clock = lambda: now[0]
+
+        self.assertEqual(backend.take("a", 2, 1), 0)
+        self.assertEqual(backend.take("a", 2, 1), 0)
+        self.assertAlmostEqual(backend.take("a", 2, 1), 1)
+        self.assertEqual(backend.take("b", 2, 1), 0)
+
+        now[0] += 0.5
+        self.assertAlmostEqual(backend.take("a", 2, 1), 0.5)
+
+        now[0] += 1
+        self.assertEqual(backend.take("a", 2, 1), 0)
+
+        backend.reset()
+        self.assertEqual(backend.take("a", 2, 1), 0)
+
+    def test_memory_backend(self):
+        self.check_backend(MemoryBackend())
+
+    def test_sqlite_backend(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "ratelimit.db")
+            self.check_backend(SQLiteBackend(path))
+
+            # another worker using the same file shares the buckets
+            other = SQLiteBackend(path)
+            other.clock = lambda: 2000.0
+            self.assertEqual(other.take("c", 1, 0.001), 0)
+            self.assertGreater(other.take("c", 1, 0.001), 0)
+
+
+class TaggedCacheTestCase(TestCase):
+    """Tests for the tagged page cache."""
+
+    def check_backend(self, backend):
+        cache = TaggedCache()
+        cache.backend = cache.tag_backend = backend
+
+        cache.set("a", 1, ["x", "y"])
+        cache.set("b", 2, ["x"])
+        self.assertEqual(cache.get("a"), 1)
+
+        cache.invalidate("y")
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(cache.get("b"), 2)
+
+        # an invalidation while the value is being made isn't lost
+        def make():
+            cache.invalidate("x")
+            return 3
+
+        self.assertEqual(cache.get_or_set("c", make, ["x"]), 3)
+        self.assertIsNone(cache.get("c"))
+        self.assertIsNone(cache.get("b"))
+
+        self.assertEqual(cache.get_or_set("d", lambda: 4, ["x"]), 4)
+        self.assertEqual(cache.get_or_set("d", lambda: 5, ["x"]), 4)
+
+        cache.clear()
+        self.assertIsNone(cache.get("d"))
+
+    def test_memory_backend(self):
+        self.check_backend(make_cache_backend("memory"))
+
+    def test_sqlite_backend(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            storage = f"sqlite:///{os.path.join(tmp, 'cache.db')}"
+            self.check_backend(make_cache_backend(storage))
+
+            # another worker using the same file shares entries & tags
+            cache = TaggedCache()
+            cache.backend = cache.tag_backend = make_cache_backend(storage)
+            other = TaggedCache()
+            other.backend = other.tag_backend = make_cache_backend(storage)
+
+            cache.set("a", {"cafe": 1}, ["x"])
+            self.assertEqual(other.get("a"), {"cafe": 1})
+            other.invalidate("x")
+            self.assertIsNone(cache.get("a"))
+
+    def test_entries_dont_evict_tags(self):
+        cache = TaggedCache()
+        cache.backend = make_cache_backend("memory", maxsize=2)
+
+        cache.set("a", 1, ["x"])
+        cache.set("b", 2, ["y"])
+        cache.set("c", 3, ["z"])
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(cache.get("b"), 2)
+        self.assertEqual(cache.get("c"), 3)
+
+    def test_concurrent_misses_make_once(self):
+        cache = TaggedCache()
+        made = []
+
+        def make():
+            made.append(1)
+            time.sleep(.1)
+            return len(made)
+
+        with ThreadPoolExecutor(5) as executor:
+            results = list(executor.map(
+                lambda _: cache.get_or_set("a", make, ["x"]), range(5)))
+
+        self.assertEqual(results, [1] * 5)
+        self.assertEqual(len(made), 1)
+
+    def test_expired_served_while_remade(self):
+        cache = TaggedCache()
+        cache.set("a", 1, ["x"], ttl=.01)
+        time.sleep(.02)
+        self.assertIsNone(cache.get("a"))
+
+        # another caller is remaking it
+        with cache.single_flight.hold("a"):
+            self.assertEqual(cache.get_or_set("a", lambda: 2), 1)
+
+        self.assertEqual(cache.get_or_set("a", lambda: 3, ["x"]), 3)
+        self.assertEqual(cache.get("a"), 3)
+
+        # invalidated entries aren't served
+        cache.invalidate("x")
+        self.assertEqual(cache.get_or_set("a", lambda: 4, ["x"]), 4)
+
+    def test_single_flight_across_processes(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            # as if in two workers: separate thread locks, same lock files
+            one = SingleFlight(tmp)
+            other = SingleFlight(tmp, timeout=.05)
+
+            with one.hold("a") as holding:
+                self.assertTrue(holding)
+
+                with other.hold("a", blocking=False) as other_holding:
+                    self.assertFalse(other_holding)
+                with other.hold("a") as other_holding:
+                    self.assertFalse(other_holding)
+                with other.hold("b") as other_holding:
+                    self.assertTrue(other_holding)
+
+            with other.hold("a", blocking=False) as other_holding:
+                self.assertTrue(other_holding)
+
+    def test_single_flight_lock_files_bounded(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            single_flight = SingleFlight(tmp)
+
+            for n in range(2 * LOCK_STRIPES):
+                with single_flight.hold(f"cafe-list:name:{n}") as holding:
+                    self.assertTrue(holding)
+
+            self.assertLessEqual(len(os.listdir(tmp)), LOCK_STRIPES)
+
+
 class AuthViewsTestCase(TestCase):
     """Tests for views on logging in/logging out/registration."""
 
     def setUp(self):
         """Before each test, add sample users."""
 
+        login_limiter.reset()
         User.query.delete()
 
         user = User.register(**TEST_USER_DATA)
@@ -539,6 +1315,101 @@ class AuthViewsTestCase(TestCase):
             self.assertIn(b"Hello, test", resp.data)
             self.assertEqual(session.get(CURR_USER_KEY), self.user_id)
 
+    def test_login_upgrades_old_hash(self):
+        user = db.session.get(User, self.user_id)
+        user.hashed_password = hash_password("secret", 4)
+        db.session.commit()
+
+        upgrades = []
+        upgrade_password = User.upgrade_password
+
+        def upgrade(user, pwd):
+            upgrades.append(upgrade_password(user, pwd))
+            return upgrades[-1]
+
+        with patch.object(User, "upgrade_password", upgrade):
+            with app.test_client() as client:
+                resp = client.post(
+                    "/login",
+                    data={"username": "test", "password": "secret"},
+                )
+                self.assertEqual(resp.status_code, 302)
+
+        self.assertEqual(len(upgrades), 1)
+        self.assertTrue(upgrades[0].result(timeout=10))
+
+        db.session.expire_all()
+        user = db.session.get(User, self.user_id)
+        self.assertEqual(get_work_factor(user.hashed_password), 9)
+        self.assertTrue(User.authenticate("test", "secret"))
+
+    def test_login_too_busy(self):
+        with app.test_client() as client:
+            with patch("models.password_hasher.check", side_effect=HasherBusy):
+                resp = client.post(
+                    "/login",
+                    data={"username": "test", "password": "secret"},
+                )
+
+            self.assertEqual(resp.status_code, 503)
+            self.assertIn(b"very busy", resp.data)
+            self.assertIsNone(session.get(CURR_USER_KEY))
+
+    def test_login_throttled(self):
+        with app.test_client() as client:
+            for i in range(login_limiter.username_burst):
+                resp = client.post(
+                    "/login",
+                    data={"username": "TEST", "password": "WRONG"},
+                )
+                self.assertEqual(resp.status_code, 200)
+
+            with patch.object(User, "authenticate") as authenticate:
+                resp = client.post(
+                    "/login",
+                    data={"username": "test", "password": "secret"},
+                )
+
+            authenticate.assert_not_called()
+            self.assertEqual(resp.status_code, 429)
+            self.assertGreater(int(resp.headers["Retry-After"]), 0)
+            self.assertIn(b"Too many login attempts", resp.data)
+            self.assertIsNone(session.get(CURR_USER_KEY))
+
+    def test_login_throttled_by_forwarded_ip(self):
+        proxied_app = create_app("testing", {"TRUSTED_PROXY_HOPS": 1})
+
+        with patch.object(login_limiter, "check", return_value=0) as check:
+            with proxied_app.test_client() as client:
+                client.post("/login",
+                            data={"username": "test", "password": "WRONG"},
+                            headers={"X-Forwarded-For": "203.0.113.7"})
+
+            with app.test_client() as client:
+                client.post("/login",
+                            data={"username": "test", "password": "WRONG"},
+                            headers={"X-Forwarded-For": "203.0.113.7"})
+
+        self.assertEqual(check.call_args_list[0].args, ("test", "203.0.113.7"))
+        self.assertEqual(check.call_args_list[1].args, ("test", "127.0.0.1"))
+
+    def test_metrics_admin_only(self):
+        admin = User.register(**ADMIN_USER_DATA)
+        db.session.add(admin)
+        db.session.commit()
+
+        with app.test_client() as client:
+            resp = client.get("/api/metrics")
+            self.assertEqual(resp.status_code, 401)
+
+            login_for_test(client, self.user_id)
+            resp = client.get("/api/metrics")
+            self.assertEqual(resp.status_code, 403)
+
+            login_for_test(client, admin.id)
+            resp = client.get("/api/metrics")
+            self.assertIn("timings", resp.json)
+
     def test_logout(self):
         with app.test_client() as client:
             login_for_test(client, self.user_id)
@@ -554,6 +1425,7 @@ class NavBarTestCase(TestCase):
     def setUp(self):
         """Before tests, add sample user."""
 
+        login_limiter.reset()
         User.query.delete()
 
         user = User.register(**TEST_USER_DATA)
@@ -585,6 +1457,28 @@ class NavBarTestCase(TestCase):
             self.assertIn(b"Log Out", resp.data)
             self.assertIn(b"Testy MacTest", resp.data)
 
+    def test_csrf_form_built_only_when_used(self):
+        with app.test_client() as client:
+            login_for_test(client, self.user_id)
+
+            with patch("app.CSRFProtectForm") as csrf_form_class:
+                client.get("/api/cafes")
+                csrf_form_class.assert_not_called()
+
+                # the navbar's logout form uses it
+                client.get("/")
+                csrf_form_class.assert_called_once()
+
+    def test_navbar_reads_session_not_db(self):
+        with app.test_client() as client:
+            client.post("/login", data={"username": "test", "password": "secret"})
+
+            with count_queries() as queries:
+                resp = client.get("/")
+
+            self.assertIn(b"Testy MacTest", resp.data)
+            self.assertEqual(queries, [])
+
 
 class ProfileViewsTestCase(TestCase):
     """Tests for views on user profiles."""
@@ -629,6 +1523,22 @@ class ProfileViewsTestCase(TestCase):
             self.assertIn(b"You are not logged in.", resp.data)
             self.assertIn(b'Welcome Back!', resp.data)
 
+    def test_user_cached_between_requests(self):
+        user_cache.clear()
+
+        with app.test_client() as client:
+            login_for_test(client, self.user_id)
+            client.get("/profile")
+
+            with count_queries() as queries:
+                client.get("/profile")
+
+            self.assertFalse([q for q in queries if "FROM users" in q])
+
+            client.post("/profile/edit", data=TEST_USER_DATA_EDIT)
+            resp = client.get("/profile")
+            self.assertIn(b"new-fn new-ln", resp.data)
+
     def test_logged_in_profile_edit(self):
         with app.test_client() as client:
             login_for_test(client, self.user_id)
@@ -681,10 +1591,63 @@ class LikeViewsTestCase(TestCase):
 
         Like.query.delete()
         User.query.delete()
+        Specialty.query.delete()
         Cafe.query.delete()
         City.query.delete()
         db.session.commit()
 
+    def test_reads_from_replica_until_write(self):
+        replica_app = create_app("testing", {
+            "SQLALCHEMY_BINDS": {"replica": os.environ["DATABASE_URL"]},
+        })
+
+        with replica_app.app_context():
+            primary = db.engine
+            replica = db.engines["replica"]
+
+        cafe_id = self.cafe.id
+
+        with replica_app.test_client() as client:
+            login_for_test(client, self.user.id)
+
+            with count_queries(primary) as on_primary, \
+                    count_queries(replica) as on_replica:
+                resp = client.get(f"/cafes/{cafe_id}")
+
+            self.assertEqual(resp.status_code, 200)
+            # what's cached is read from the primary, in case the replica
+            # is behind
+            self.assertEqual(len(on_primary), 1)
+            self.assertNotEqual(on_replica, [])
+
+            with count_queries(primary) as on_primary, \
+                    count_queries(replica) as on_replica:
+                client.get(f"/cafes/{cafe_id}")
+
+            self.assertEqual(on_primary, [])
+            self.assertNotEqual(on_replica, [])
+
+            resp = client.put(f"/api/cafes/{cafe_id}/like")
+            self.assertTrue(resp.json["liked"])
+            self.assertIsNotNone(client.get_cookie("primary_until"))
+
+            # read your writes: the next reads go to the primary
+            with count_queries(primary) as on_primary, \
+                    count_queries(replica) as on_replica:
+                resp = client.get("/api/likes",
+                                  query_string={"cafe_id": cafe_id})
+
+            self.assertEqual(resp.json, {"likes": True})
+            self.assertNotEqual(on_primary, [])
+            self.assertEqual(on_replica, [])
+
+            client.delete_cookie("primary_until")
+
+            with count_queries(replica) as on_replica:
+                client.get("/api/likes", query_string={"cafe_id": cafe_id})
+
+            self.assertNotEqual(on_replica, [])
+
     def test_profile_no_likes(self):
         with app.test_client() as client:
             login_for_test(client, self.user.id)
@@ -703,6 +1666,107 @@ class LikeViewsTestCase(TestCase):
 
             self.assertIn(b"Test Cafe", resp.data)
 
+    def test_likes_cafe(self):
+        self.assertFalse(self.user.likes_cafe(self.cafe.id))
+
+        self.user.liked_cafes.append(self.cafe)
+        db.session.commit()
+
+        self.assertTrue(self.user.likes_cafe(self.cafe.id))
+        self.assertTrue(Like.exists(self.user.id, self.cafe.id))
+
+    def test_detail_like_button(self):
+        with app.test_client() as client:
+            login_for_test(client, self.user.id)
+            resp = client.get(f"/cafes/{self.cafe.id}")
+            self.assertIn(b'aria-label="Like"', resp.data)
+
+            self.user.liked_cafes.append(self.cafe)
+            db.session.commit()
+
+            resp = client.get(f"/cafes/{self.cafe.id}")
+            self.assertIn(b'aria-label="Unlike"', resp.data)
+
+    def test_shared_pages(self):
+        self.user.liked_cafes.append(self.cafe)
+        db.session.commit()
+        app.config['SHARED_PAGES'] = True
+
+        try:
+            with app.test_client() as client:
+                login_for_test(client, self.user.id)
+                with client.session_transaction() as sess:
+                    sess["_flashes"] = [("success", "Cafe edited!")]
+
+                resp = client.get(f"/cafes/{self.cafe.id}")
+                html = resp.get_data(as_text=True)
+                self.assertIn("anon-like-btn", html)
+                self.assertIn("admin-only d-none", html)
+                self.assertNotIn(self.user.get_full_name(), html)
+                self.assertNotIn("Cafe edited!", html)
+                self.assertEqual(resp.headers["Cache-Control"],
+                                 "public, max-age=0, s-maxage=60")
+                self.assertNotIn("Cookie", resp.headers.get("Vary", ""))
+
+                resp = client.get(
+                    "/api/me/state",
+                    query_string={"cafe_ids": f"{self.cafe.id},0"})
+                self.assertEqual(resp.json["user"]["id"], self.user.id)
+                self.assertEqual(resp.json["likes"],
+                                 {str(self.cafe.id): True, "0": False})
+                self.assertEqual(resp.json["flashes"],
+                                 [["success", "Cafe edited!"]])
+                self.assertIn("no-store", resp.headers["Cache-Control"])
+
+                # flashes are shown once
+                resp = client.get("/api/me/state")
+                self.assertEqual(resp.json["flashes"], [])
+                self.assertEqual(resp.json["likes"], {})
+        finally:
+            app.config['SHARED_PAGES'] = False
+
+        with app.test_client() as client:
+            resp = client.get("/api/me/state",
+                              query_string={"cafe_ids": "x"})
+            self.assertEqual(resp.status_code, 400)
+            self.assertIsNone(client.get("/api/me/state").json["user"])
+
+    def test_detail_query_counts(self):
+        cafe_id = self.cafe.id
+        db.session.add(Specialty(name="Latte", type="beverage",
+                                 cafe_id=cafe_id))
+        db.session.commit()
+        login_limiter.reset()
+
+        with app.test_client() as client:
+            with count_queries() as anon_queries:
+                resp = client.get(f"/cafes/{cafe_id}")
+            self.assertIn(b"Latte", resp.data)
+            self.assertIn(b"San Francisco, CA", resp.data)
+
+            client.post("/login",
+                        data={"username": "test", "password": "secret"})
+
+            with count_queries() as queries:
+                resp = client.get(f"/cafes/{cafe_id}")
+            self.assertIn(b'aria-label="Like"', resp.data)
+
+            client.put(f"/api/cafes/{cafe_id}/like")
+
+            with count_queries() as liked_queries:
+                resp = client.get(f"/cafes/{cafe_id}")
+            self.assertIn(b'aria-label="Unlike"', resp.data)
+
+            resp = client.get("/cafes/0")
+            self.assertEqual(resp.status_code, 404)
+
+        # anonymous: the validator (for the ETag & cache key), then the cafe
+        self.assertEqual(len(anon_queries), 2)
+        # logged in: the validator, then whether they like the cached cafe
+        self.assertEqual(len(queries), 2)
+        # the cafe page doesn't show like counts, so it's still cached
+        self.assertEqual(len(liked_queries), 2)
+
     # Tests for JSON API routes
     def test_anon_check_if_like(self):
         with app.test_client() as client:
@@ -733,6 +1797,46 @@ class LikeViewsTestCase(TestCase):
 
             self.assertEqual({"likes": True}, data)
 
+    def test_check_if_like_batch(self):
+        other = Cafe(**CAFE_DATA_NEW)
+        db.session.add(other)
+        self.user.liked_cafes.append(self.cafe)
+        db.session.commit()
+
+        expected = {"likes": {str(self.cafe.id): True, str(other.id): False}}
+
+        with app.test_client() as client:
+            login_for_test(client, self.user.id)
+
+            with count_queries() as queries:
+                resp = client.get(
+                    "/api/likes",
+                    query_string={"cafe_ids": f"{self.cafe.id},{other.id}"})
+            self.assertEqual(resp.json, expected)
+            self.assertEqual(
+                len([q for q in queries if "cafes_users" in q]), 1)
+
+            resp = client.post(
+                "/api/likes", json={"cafe_ids": [self.cafe.id, other.id]})
+            self.assertEqual(resp.json, expected)
+
+    def test_check_if_like_batch_invalid(self):
+        with app.test_client() as client:
+            login_for_test(client, self.user.id)
+
+            resp = client.get("/api/likes", query_string={"cafe_ids": "1,x"})
+            self.assertEqual(resp.status_code, 400)
+
+            resp = client.post("/api/likes",
+                               json={"cafe_ids": list(range(501))})
+            self.assertEqual(resp.status_code, 400)
+            self.assertEqual(resp.json, {"error": "Invalid cafe_ids"})
+
+            for body in [[1, 2], "1", None]:
+                resp = client.post("/api/likes", json=body)
+                self.assertEqual(resp.status_code, 400)
+                self.assertEqual(resp.json, {"error": "Invalid cafe_ids"})
+
     def test_anon_add_like(self):
         with app.test_client() as client:
             resp = client.post("/api/like",
@@ -751,6 +1855,27 @@ class LikeViewsTestCase(TestCase):
             self.assertEqual({"liked": self.cafe.id}, data)
             self.assertEqual(self.cafe in self.user.liked_cafes, True)
     
+    def test_add_like_skips_loading_cafes(self):
+        cafe_id = self.cafe.id
+
+        with app.test_client() as client:
+            login_for_test(client, self.user.id)
+
+            with count_queries() as queries:
+                resp = client.post("/api/like", json={"cafe_id": cafe_id})
+
+            self.assertEqual({"liked": cafe_id}, resp.json)
+            self.assertFalse(
+                [q for q in queries if re.search(r"FROM cafes\b(?!_)", q)])
+
+    def test_add_like_no_such_cafe(self):
+        with app.test_client() as client:
+            login_for_test(client, self.user.id)
+            resp = client.post("/api/like",
+                               json={"cafe_id": self.cafe.id + 1000})
+
+            self.assertEqual(resp.status_code, 404)
+
     def test_logged_in_add_like_duplicate(self):
         with app.test_client() as client:
             login_for_test(client, self.user.id)
@@ -792,3 +1917,78 @@ class LikeViewsTestCase(TestCase):
 
             self.assertEqual({"error": "Not in your likes."}, data)
             self.assertEqual(self.cafe in self.user.liked_cafes, False)
+
+    def test_anon_set_like(self):
+        with app.test_client() as client:
+            resp = client.put(f"/api/cafes/{self.cafe.id}/like")
+
+            self.assertEqual({"error": "Not logged in"}, resp.json)
+
+    def test_logged_in_set_like(self):
+        with app.test_client() as client:
+            login_for_test(client, self.user.id)
+            url = f"/api/cafes/{self.cafe.id}/like"
+
+            for _ in range(2):
+                resp = client.put(url)
+                self.assertEqual(
+                    {"cafe_id": self.cafe.id, "liked": True, "like_count": 1},
+                    resp.json)
+            self.assertTrue(Like.exists(self.user.id, self.cafe.id))
+
+            for _ in range(2):
+                resp = client.delete(url)
+                self.assertEqual(
+                    {"cafe_id": self.cafe.id, "liked": False, "like_count": 0},
+                    resp.json)
+            self.assertFalse(Like.exists(self.user.id, self.cafe.id))
+
+    def test_set_like_no_such_cafe(self):
+        with app.test_client() as client:
+            login_for_test(client, self.user.id)
+            resp = client.put(f"/api/cafes/{self.cafe.id + 1000}/like")
+
+            self.assertEqual(resp.status_code, 404)
+
+            resp = client.delete(f"/api/cafes/{self.cafe.id + 1000}/like")
+
+            self.assertEqual(resp.status_code, 404)
+
+    def test_reconcile_like_counts(self):
+        self.user.liked_cafes.append(self.cafe)
+        db.session.commit()
+        self.assertEqual(self.cafe.like_count, 0)
+
+        self.assertEqual(Cafe.reconcile_like_counts(), 1)
+        db.session.commit()
+        self.assertEqual(self.cafe.like_count, 1)
+
+        self.assertEqual(Cafe.reconcile_like_counts(), 0)
+
+    def test_popular_sort(self):
+        other = Cafe(**CAFE_DATA_NEW)
+        db.session.add(other)
+        db.session.commit()
+
+        with app.test_client() as client:
+            login_for_test(client, self.user.id)
+            client.put(f"/api/cafes/{self.cafe.id}/like")
+
+            resp = client.get("/api/cafes",
+                              query_string={"sort": "popular", "limit": 1})
+            data = resp.json
+            self.assertEqual([(c["id"], c["like_count"]) for c in data["cafes"]],
+                             [(self.cafe.id, 1)])
+
+            resp = client.get(
+                "/api/cafes",
+                query_string={"sort": "popular", "after": data["next"]})
+            self.assertEqual([c["id"] for c in resp.json["cafes"]],
+                             [other.id])
+
+            resp = client.get("/cafes", query_string={"sort": "popular"})
+            html = resp.data.decode("utf8")
+            self.assertLess(html.index("Test Cafe"), html.index("Another Cafe"))
+
+            resp = client.get("/cafes", query_string={"sort": "likes"})
+            self.assertEqual(resp.status_code, 400)
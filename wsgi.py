@@ -0,0 +1,20 @@
+"""WSGI entry point for Flask Cafe.
+
+Run it with a pre-fork server that loads the app once in the parent and
+forks workers from it, e.g. gunicorn with the settings in gunicorn.conf.py:
+
+    FLASK_CONFIG=production gunicorn -c gunicorn.conf.py wsgi:app
+
+The parent warms up here (templates, city registry) so workers start ready
+and share that memory copy-on-write; gunicorn.conf.py then calls
+app.after_fork in each worker so none share the parent's connections.
+
+Behind proxies (nginx, a CDN), set TRUSTED_PROXY_HOPS to how many there
+are, so client IPs (which login rate limits are per) come from
+X-Forwarded-For; otherwise every client looks like the nearest proxy.
+"""
+
+from app import create_app, warm_up
+
+app = create_app()
+warm_up(app)